@@ -14,5 +14,12 @@ manager.add_command('db', MigrateCommand)
 def sync_soundcloud():
     SoundcloudTrack.sync()
 
+
+@manager.command
+def warm_cache():
+    """ Cache the busiest pages, eg. after a deploy. """
+    import pmg.tasks
+    pmg.tasks.warm_cache()
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#
+# Compare the speed of the JSON encoders used for API responses, using real
+# list responses from the API views.
+#
+#   python bin/benchmark-json.py --per-page 500 /v2/committee-meetings/ /committee-meeting/
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+from pmg import app
+from pmg.api.v1 import IN_PROCESS_ENVIRON_KEY
+from pmg.models.serializers import LazyJSON, to_json, to_json_fast
+
+
+def load_response_data(path, per_page):
+    """ The unencoded data that the API view for +path+ responds with. """
+    with app.test_request_context(path, base_url='http://api.%s/' % app.config['SERVER_NAME'],
+                                  query_string={'per_page': per_page},
+                                  environ_overrides={IN_PROCESS_ENVIRON_KEY: True}):
+        response = app.make_response(app.dispatch_request())
+        if not isinstance(response.response, LazyJSON):
+            raise ValueError("%s did not return an API response" % path)
+        return response.response.data
+
+
+def benchmark(path, data, repeat):
+    if to_json(data) != to_json_fast(data):
+        print "%s: WARNING, encoders produce different output" % path
+
+    results = []
+    for encoder in [to_json, to_json_fast]:
+        best = min(timeit.repeat(lambda: encoder(data), number=1, repeat=repeat))
+        results.append(best)
+        print "%s: %s %.2f ms" % (path, encoder.__name__, best * 1000)
+
+    print "%s: %.1fx faster" % (path, results[0] / results[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark JSON encoding of API responses')
+    parser.add_argument('paths', metavar='PATH', nargs='+', help='API list paths, such as /v2/committee-meetings/')
+    parser.add_argument('--per-page', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        for path in args.paths:
+            benchmark(path, load_response_data(path, args.per_page), args.repeat)
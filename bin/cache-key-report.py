@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Report how many distinct cache keys the requests in an access log produce,
+# per endpoint, compared to the number of distinct URLs. Endpoints with many
+# keys per URL, or many keys overall, have poor cache hit rates.
+#
+# Each line of the log must contain a request path, optionally preceded by
+# the method (as in nginx and gunicorn access logs) or a full URL.
+#
+#   python bin/cache-key-report.py --host api.pmg.org.za access.log
+
+import argparse
+import os
+import re
+import sys
+from collections import defaultdict
+
+from flask import request
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+from pmg import app, canonical_url
+
+REQUEST_RE = re.compile(r'(?:"(?:GET|HEAD) |^)(https?://[^/\s]+)?(/\S*)')
+
+
+def report(lines, host):
+    urls = defaultdict(set)
+    keys = defaultdict(set)
+    hits = defaultdict(int)
+
+    for line in lines:
+        match = REQUEST_RE.search(line.strip())
+        if not match:
+            continue
+
+        base_url = match.group(1) or ('http://' + host)
+        with app.test_request_context(match.group(2), base_url=base_url + '/'):
+            endpoint = request.endpoint
+            if not endpoint:
+                continue
+
+            urls[endpoint].add(request.url)
+            keys[endpoint].add(canonical_url(request))
+            hits[endpoint] += 1
+
+    print "%-50s %10s %10s %10s" % ('endpoint', 'requests', 'urls', 'keys')
+    for endpoint in sorted(keys, key=lambda e: len(keys[e]), reverse=True):
+        print "%-50s %10d %10d %10d" % (endpoint, hits[endpoint], len(urls[endpoint]), len(keys[endpoint]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cache key cardinality report')
+    parser.add_argument('log', type=argparse.FileType('r'), help='Access log file, or - for stdin')
+    parser.add_argument('--host', default=app.config['SERVER_NAME'], help='Host for log lines without one')
+    args = parser.parse_args()
+
+    report(args.log, args.host)
@@ -12,9 +12,16 @@ if __name__ == "__main__":
     data_types = Transforms.data_types() + ['all']
 
     parser = argparse.ArgumentParser(description='ElasticSearch PMG library')
-    parser.add_argument('data_type', metavar='DATA_TYPE', choices=data_types, help='Data type to manipulate: %s' % data_types)
-    parser.add_argument('--reindex', action="store_true")
-    parser.add_argument('--delete', action="store_true")
+    parser.add_argument('data_type', metavar='DATA_TYPE', choices=data_types, nargs='?', default='all',
+                        help='Data type to manipulate: %s' % data_types)
+    parser.add_argument('--reindex', action="store_true",
+                        help="Reindex DATA_TYPE. Reindexing all builds a new index and then switches to it.")
+    parser.add_argument('--sync', action="store_true",
+                        help="Index DATA_TYPE items changed since it was last synced, and remove deleted items")
+    parser.add_argument('--queue', action="store_true", help="Index the items queued for reindexing")
+    parser.add_argument('--delete', action="store_true", help="Delete all indexes")
+    parser.add_argument('--indexes', action="store_true", help="List the indexes, marking the live one")
+    parser.add_argument('--swap', metavar='INDEX', help="Switch to INDEX, and delete the current index")
     args = parser.parse_args()
 
     search = Search()
@@ -26,5 +33,24 @@ if __name__ == "__main__":
             else:
                 search.reindex_all(args.data_type)
 
+    if args.sync:
+        with app.app_context():
+            if args.data_type == 'all':
+                search.sync_all()
+            else:
+                search.sync(args.data_type)
+
+    if args.queue:
+        with app.app_context():
+            search.index_queued()
+
+    if args.indexes:
+        live = search.live_indices()
+        for index in sorted(set(search.indices() + live)):
+            print index + (' (live)' if index in live else '')
+
+    if args.swap:
+        search.swap_index(args.swap)
+
     if args.delete:
         search.delete_everything()
@@ -10,6 +10,35 @@ DEBUG_CACHE = env.get('FLASK_DEBUG_CACHE', "false") == 'true'
 
 RUN_PERIODIC_TASKS = env.get('RUN_PERIODIC_TASKS') == 'true'
 
+# Should the frontend dispatch API calls directly to the API views in this
+# process, rather than making HTTP requests to API_URL?
+API_IN_PROCESS = env.get('API_IN_PROCESS') == 'true'
+
+# Unfiltered API lists with at least this many rows report PostgreSQL's
+# estimated row count rather than an exact count. 0 always counts exactly.
+API_COUNT_ESTIMATE_THRESHOLD = int(env.get('API_COUNT_ESTIMATE_THRESHOLD', '0'))
+
+# Cached pages and API responses are shared between workers and hosts through
+# redis. Without it, each host has its own filesystem cache.
+CACHE_REDIS_URL = env.get('CACHE_REDIS_URL')
+# Each process also keeps recently used entries in memory, for a short while
+CACHE_LOCAL_MAX_BYTES = int(env.get('CACHE_LOCAL_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_LOCAL_TIMEOUT = int(env.get('CACHE_LOCAL_TIMEOUT', 60))
+# Query params that don't change a page, and so aren't part of cache keys
+CACHE_KEY_IGNORED_PARAMS = env.get('CACHE_KEY_IGNORED_PARAMS', 'via,utm_*,fbclid,gclid').split(',')
+# Hosts that serve the same content, and so can share cache entries, eg.
+# {'www.pmg.org.za': 'pmg.org.za'}. API responses link to the host they were
+# requested from, so api-internal can't share entries with api.
+CACHE_KEY_HOST_ALIASES = {}
+# Cached pages are served for this long after they expire, while they're refreshed
+CACHE_STALE_TIMEOUT = int(env.get('CACHE_STALE_TIMEOUT', 60 * 60 * 24))
+# Larger entries aren't cached at all
+CACHE_MAX_ITEM_BYTES = int(env.get('CACHE_MAX_ITEM_BYTES', 2 * 1024 * 1024))
+# Pages that pmg.tasks.warm_cache keeps cached, along with the popular committees
+CACHE_WARM_URLS = env.get('CACHE_WARM_URLS', '/,/committees/,/bills/current/').split(',')
+CACHE_WARM_CONCURRENCY = int(env.get('CACHE_WARM_CONCURRENCY', 4))
+CACHE_WARM_PERIOD_MINUTES = env.get('CACHE_WARM_PERIOD_MINUTES', '10')
+
 WTF_CSRF_ENABLED = True
 SECRET_KEY = env.get('FLASK_SECRET_KEY',
                      "NSTHNSTHaoensutCGSRCGnsthoesucgsrSNTH")
@@ -36,7 +65,11 @@ PREMIUM_FREE_BEFORE = datetime.datetime(
     datetime.datetime.today().year - 1, 1, 1, tzinfo=pytz.utc)
 
 ES_SERVER = env.get("ES_SERVER", 'http://localhost:9200')
-SEARCH_REINDEX_CHANGES = not DEBUG  # reindex changes to models
+SEARCH_REINDEX_CHANGES = env.get('SEARCH_REINDEX_CHANGES', str(not DEBUG).lower()) == 'true'  # reindex changes to models
+# index the items queued by reindexing changes this often
+SEARCH_QUEUE_PERIOD_SECONDS = int(env.get('SEARCH_QUEUE_PERIOD_SECONDS', 15))
+# sync changes to the search index this often, instead of or as well as reindexing changes (blank to disable)
+SEARCH_SYNC_PERIOD_MINUTES = env.get('SEARCH_SYNC_PERIOD_MINUTES', '')
 SEARCH_RESULTS_PER_PAGE = 20
 
 SOUNDCLOUD_APP_KEY_ID = env.get("SOUNDCLOUD_APP_KEY_ID", '')
@@ -0,0 +1,29 @@
+"""file-text
+
+Revision ID: 2e8a5c1f9b46
+Revises: 9d3f6b2a8e17
+Create Date: 2026-10-18 17:48:12.305518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e8a5c1f9b46'
+down_revision = '9d3f6b2a8e17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'file_text',
+        sa.Column('file_id', sa.Integer(), nullable=False),
+        sa.Column('content_hash', sa.String(length=100), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(['file_id'], ['file.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('file_id')
+    )
+
+
+def downgrade():
+    op.drop_table('file_text')
@@ -0,0 +1,22 @@
+"""event-date-id-index
+
+Revision ID: 3f1c7a9d2e54
+Revises: 270efdf57cc
+Create Date: 2026-10-18 09:12:41.220318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1c7a9d2e54'
+down_revision = '270efdf57cc'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('event_date_id_ix', 'event', ['date', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('event_date_id_ix', table_name='event')
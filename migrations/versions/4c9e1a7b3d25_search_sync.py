@@ -0,0 +1,27 @@
+"""search-sync
+
+Revision ID: 4c9e1a7b3d25
+Revises: 7b2d4e8f1a63
+Create Date: 2026-10-18 16:21:09.183342
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c9e1a7b3d25'
+down_revision = '7b2d4e8f1a63'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'search_sync',
+        sa.Column('data_type', sa.String(length=50), nullable=False),
+        sa.Column('synced_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('data_type')
+    )
+
+
+def downgrade():
+    op.drop_table('search_sync')
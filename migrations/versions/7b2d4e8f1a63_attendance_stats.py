@@ -0,0 +1,84 @@
+"""attendance-stats
+
+Revision ID: 7b2d4e8f1a63
+Revises: 3f1c7a9d2e54
+Create Date: 2026-10-18 14:03:27.511904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b2d4e8f1a63'
+down_revision = '3f1c7a9d2e54'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# matches CommitteeMeetingAttendance.recorded_period
+PERIOD = """
+    CASE WHEN a.created_at <= '2019-06-30' THEN 'historical'
+         WHEN a.created_at >= '2019-07-01' THEN 'current'
+         ELSE 'other' END
+"""
+
+
+def upgrade():
+    op.create_table(
+        'committee_meeting_attendance_stats',
+        sa.Column('meeting_id', sa.Integer(), nullable=False),
+        sa.Column('period', sa.String(length=10), nullable=False),
+        sa.Column('committee_id', sa.Integer(), nullable=True),
+        sa.Column('date', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('n_present', sa.Integer(), nullable=False),
+        sa.Column('n_members', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['committee_id'], ['committee.id'], name=op.f('fk_committee_meeting_attendance_stats_committee_id_committee'), ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['meeting_id'], ['event.id'], name=op.f('fk_committee_meeting_attendance_stats_meeting_id_event'), ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('meeting_id', 'period', name=op.f('pk_committee_meeting_attendance_stats'))
+    )
+    op.create_index(op.f('ix_committee_meeting_attendance_stats_committee_id'), 'committee_meeting_attendance_stats', ['committee_id'], unique=False)
+
+    op.create_table(
+        'member_attendance_stats',
+        sa.Column('member_id', sa.Integer(), nullable=False),
+        sa.Column('committee_id', sa.Integer(), nullable=False),
+        sa.Column('year', sa.Integer(), nullable=False),
+        sa.Column('period', sa.String(length=10), nullable=False),
+        sa.Column('attendance', sa.String(length=3), nullable=False),
+        sa.Column('n_meetings', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['committee_id'], ['committee.id'], name=op.f('fk_member_attendance_stats_committee_id_committee'), ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['member_id'], ['member.id'], name=op.f('fk_member_attendance_stats_member_id_member'), ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('member_id', 'committee_id', 'year', 'period', 'attendance', name=op.f('pk_member_attendance_stats'))
+    )
+    op.create_index('member_attendance_stats_committee_year_ix', 'member_attendance_stats', ['committee_id', 'year'], unique=False)
+
+    op.execute("""
+        INSERT INTO committee_meeting_attendance_stats (meeting_id, period, committee_id, date, n_present, n_members)
+        SELECT meeting_id, period, committee_id, date, sum(present), count(1)
+        FROM (
+            SELECT a.meeting_id, %s AS period, e.committee_id, e.date,
+                   CASE WHEN a.attendance IN ('DE', 'L', 'LDE', 'P') THEN 1 ELSE 0 END AS present
+            FROM committee_meeting_attendance a
+            INNER JOIN event e ON e.id = a.meeting_id
+        ) AS rows
+        GROUP BY meeting_id, period, committee_id, date
+    """ % PERIOD)
+
+    op.execute("""
+        INSERT INTO member_attendance_stats (member_id, committee_id, year, period, attendance, n_meetings)
+        SELECT member_id, committee_id, year, period, attendance, count(1)
+        FROM (
+            SELECT a.member_id, e.committee_id, CAST(date_part('year', e.date) AS INTEGER) AS year,
+                   %s AS period, a.attendance
+            FROM committee_meeting_attendance a
+            INNER JOIN event e ON e.id = a.meeting_id
+            WHERE e.committee_id IS NOT NULL
+        ) AS rows
+        GROUP BY member_id, committee_id, year, period, attendance
+    """ % PERIOD)
+
+
+def downgrade():
+    op.drop_index('member_attendance_stats_committee_year_ix', table_name='member_attendance_stats')
+    op.drop_table('member_attendance_stats')
+    op.drop_index(op.f('ix_committee_meeting_attendance_stats_committee_id'), table_name='committee_meeting_attendance_stats')
+    op.drop_table('committee_meeting_attendance_stats')
@@ -0,0 +1,29 @@
+"""search-queue
+
+Revision ID: 9d3f6b2a8e17
+Revises: 4c9e1a7b3d25
+Create Date: 2026-10-18 17:02:44.620915
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d3f6b2a8e17'
+down_revision = '4c9e1a7b3d25'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'search_queue',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text(u'now()'), nullable=False),
+        sa.Column('slug_prefix', sa.String(length=50), nullable=False),
+        sa.Column('model_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('search_queue')
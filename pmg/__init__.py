@@ -5,7 +5,6 @@ import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from flask_caching import Cache
 from flask_wtf.csrf import CsrfProtect
 from flask_mail import Mail
 from flask_marshmallow import Marshmallow
@@ -14,6 +13,11 @@ import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 
 import json
+from fnmatch import fnmatch
+
+from werkzeug.urls import url_encode
+
+from pmg.caching import Cache, tag_versions
 
 env = os.environ.get('FLASK_ENV', 'development')
 
@@ -36,7 +40,8 @@ logger = logging.getLogger(__name__)
 if app.config['DEBUG'] and not app.config['DEBUG_CACHE']:
     cache_type = 'null'
 else:
-    cache_type = 'filesystem'
+    # in-process LRU cache in front of redis or the filesystem, see pmg.caching
+    cache_type = 'pmg.caching.tiered'
 
 cache = Cache(
     app,
@@ -58,10 +63,50 @@ def should_skip_cache(request, current_user):
         return True
 
 
-def cache_key(request):
+def canonical_url(request):
+    """ The URL of +request+, normalised so that requests for the same content
+    share a cache entry: the host is lowercased and aliased using
+    CACHE_KEY_HOST_ALIASES, trailing slashes are dropped, query params are
+    sorted and those matching CACHE_KEY_IGNORED_PARAMS are dropped.
+    """
+    host = request.host.lower()
+    host = app.config['CACHE_KEY_HOST_ALIASES'].get(host, host)
+    path = request.path.rstrip('/') or '/'
+
+    ignored = app.config['CACHE_KEY_IGNORED_PARAMS']
+    params = sorted((k, v) for k, v in request.args.iteritems(multi=True)
+                    if not any(fnmatch(k, pattern) for pattern in ignored))
+
+    url = host + path
+    if params:
+        url = url + '?' + url_encode(params)
+    return url
+
+
+# Cache timeout for views whose entries are tagged, and so are invalidated
+# when the content they depend on changes
+LONG_CACHE_TIMEOUT = 60 * 60 * 24 * 3
+
+
+def cache_key(request, tags=None):
+    """ The cache key for +request+.
+
+    +tags+ are the things that the response depends on, such as
+    "Committee:{committee_id}" or "model:Bill", formatted with the request's
+    view args. It can also be a function returning the tags. The key includes
+    the current version of each tag, so when a tag is invalidated, a new key
+    (and response) is used. See pmg.caching.
+    """
+    key = canonical_url(request)
+    if tags:
+        if callable(tags):
+            tags = tags()
+        tags = [t.format(**request.view_args) for t in tags]
+        key = '%s|%s' % (key, ','.join(tag_versions(tags)))
+
     if app.config['DEBUG_CACHE']:
-        logger.debug("cache key %r", request.url)
-    return request.url
+        logger.debug("cache key %r", key)
+    return key
 
 
 db = SQLAlchemy(app, session_options={"autoflush": False})
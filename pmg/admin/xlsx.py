@@ -1,5 +1,6 @@
 import xlsxwriter
 import StringIO
+import tempfile
 
 
 class XLSXBuilder:
@@ -42,6 +43,31 @@ class XLSXBuilder:
 
         return output, workbook
 
+    def new_streaming_workbook(self):
+        """ A workbook for large sheets, which keeps only the current row in
+        memory, and is written to a temporary file.
+        """
+        output = tempfile.TemporaryFile()
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+
+        self.formats['date'] = workbook.add_format({'num_format': 'yyyy/mm/dd'})
+        self.formats['bold'] = workbook.add_format({'bold': True})
+
+        return output, workbook
+
+    def write_rows(self, ws, keys, rows):
+        """ Write a header row of +keys+, followed by +rows+ (any iterable) in order.
+        Unlike write_table, this works with streaming workbooks.
+        """
+        ws.write_row(0, 0, keys, self.formats['bold'])
+
+        n = 0
+        for n, row in enumerate(rows, 1):
+            ws.write_row(n, 0, row)
+        ws.autofilter(0, 0, n, len(keys) - 1)
+
+        return n + 1
+
     def write_table(self, ws, rows, rownum=0, colnum=0):
         if rows:
             keys = rows[0]
@@ -1,15 +1,32 @@
 import logging
 import urllib
+import urlparse
 import json
+import math
 
-from flask import flash, session, abort, redirect, url_for, request, render_template
+import gevent
+import gevent.pool
+from flask import flash, session, abort, redirect, url_for, request, render_template, copy_current_request_context
 from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
 from flask_security import current_user
 import urllib3
 
 from pmg import app
+from pmg.api.v1 import IN_PROCESS_ENVIRON_KEY
+from pmg.models.serializers import LazyJSON, to_jsonable
 
 API_URL = app.config['API_URL']
+# dispatch API requests directly to the API views in this process?
+API_IN_PROCESS = app.config['API_IN_PROCESS']
+# redirects to follow for in-process requests, such as adding a trailing slash
+MAX_IN_PROCESS_REDIRECTS = 5
+# seconds to wait for each load in load_many_from_api
+BATCH_TIMEOUT = 20
+# most pages to fetch when loading everything
+MAX_PAGES = 1000
+# number of pages to fetch at once when loading everything
+PAGE_CONCURRENCY = 8
 # timeout connecting and reading from remote host
 TIMEOUTS = urllib3.Timeout(connect=3.05, read=10)
 
@@ -19,8 +36,8 @@ logger = logging.getLogger(__name__)
 # https://urllib3.readthedocs.org/en/latest/security.html#insecurerequestwarning
 urllib3.disable_warnings()
 
-# thread-safe connection pool
-http = urllib3.PoolManager(timeout=TIMEOUTS, maxsize=3)
+# thread-safe connection pool, big enough for concurrent page loads
+http = urllib3.PoolManager(timeout=TIMEOUTS, maxsize=PAGE_CONCURRENCY)
 
 
 class ApiException(HTTPException):
@@ -86,30 +103,18 @@ def load_from_api(resource_name, resource_id=None, page=None, return_everything=
         headers = {'Authentication-Token': current_user.get_auth_token()}
 
     try:
-        response = http.request('GET', API_URL + query_str, headers=headers, fields=params)
+        status, out = api_request(API_URL + query_str, headers, params)
 
-        if response.status == 404:
+        if status == 404:
             abort(404)
 
-        if response.status != 200 and response.status not in [401, 403]:
-            try:
-                msg = response_json(response).get('message')
-            except Exception:
-                msg = None
-
-            raise ApiException(response.status, msg or "An unspecified error has occurred.")
-
-        out = response_json(response)
-        if return_everything:
-            next_response_json = out
-            i = 0
-            while next_response_json.get('next') and i < 1000:
-                next_response = http.request('GET', next_response_json.get('next'), headers=headers)
-                next_response_json = response_json(next_response)
-                out['results'] += next_response_json['results']
-                i += 1
-            if out.get('next'):
-                out.pop('next')
+        if status != 200 and status not in [401, 403]:
+            msg = out.get('message') if isinstance(out, dict) else None
+            raise ApiException(status, msg or "An unspecified error has occurred.")
+
+        if return_everything and out.get('next'):
+            out['results'] += load_remaining_pages(API_URL + query_str, headers, params, out)
+            out.pop('next')
 
         return out
     except urllib3.exceptions.HTTPError as e:
@@ -118,5 +123,189 @@ def load_from_api(resource_name, resource_id=None, page=None, return_everything=
         raise e
 
 
+def load_remaining_pages(url, headers, params, first):
+    """ Load the results of all the pages that follow the +first+ response.
+
+    The total count and page size are known from the first response, so the
+    remaining pages are fetched concurrently and then stitched together in
+    order. If the count isn't available, the 'next' links are followed one
+    at a time instead.
+
+    The count may be an estimate (see pmg.api.counts), so if the last page
+    is full, the pages after it are loaded one at a time until one isn't.
+    """
+    count = first.get('count')
+    per_page = len(first['results'])
+    if not count or not per_page:
+        return follow_next_pages(first, headers)
+
+    first_page = int(params.get('page', 0))
+    n_pages = int(math.ceil(float(count) / per_page))
+    pages = range(first_page + 1, min(n_pages, first_page + 1 + MAX_PAGES))
+
+    pool = gevent.pool.Pool(PAGE_CONCURRENCY)
+    jobs = [pool.spawn(copy_current_request_context(load_page), url, headers, params, page)
+            for page in pages]
+    gevent.joinall(jobs, raise_error=True)
+
+    results = []
+    for job in jobs:
+        results += job.value
+
+    page = pages[-1] if pages else first_page
+    last = jobs[-1].value if jobs else first['results']
+    while len(last) >= per_page and page - first_page < MAX_PAGES:
+        page += 1
+        last = load_page(url, headers, params, page)
+        results += last
+
+    return results
+
+
+def load_page(url, headers, params, page):
+    """ Load the results for a single page of a list.
+    """
+    params = dict(params)
+    params['page'] = str(page)
+    status, data = api_request(url, headers, params)
+
+    if status != 200:
+        msg = data.get('message') if isinstance(data, dict) else None
+        raise ApiException(status, msg or "An unspecified error has occurred.")
+
+    return data['results']
+
+
+def follow_next_pages(first, headers):
+    """ Load the results of the pages after +first+ by following the 'next'
+    links one at a time.
+    """
+    results = []
+    next_response_json = first
+    i = 0
+    while next_response_json.get('next') and i < MAX_PAGES:
+        status, next_response_json = api_request(next_response_json.get('next'), headers)
+        results += next_response_json['results']
+        i += 1
+    return results
+
+
+def load_many_from_api(loads, timeout=BATCH_TIMEOUT):
+    """ Load several independent resources from the PMG API concurrently,
+    so that the time taken is that of the slowest load, rather than the
+    sum of them all. Each load runs in its own greenlet with a copy of the
+    current request context.
+
+    If any loads fail, all the errors are logged and the first one is raised,
+    just as if the loads had been done one after the other.
+
+    :param dict loads: map from a name to a dict of keyword arguments for :func:`load_from_api`
+    :param float timeout: seconds to wait for each load before giving up on it
+    :return: map from each name to the loaded data
+    """
+    jobs = [(name, gevent.spawn(copy_current_request_context(_load_in_greenlet), name, kwargs, timeout))
+            for name, kwargs in loads.iteritems()]
+    gevent.joinall([job for name, job in jobs])
+
+    results = {}
+    errors = []
+    for name, job in jobs:
+        result, error = job.value
+        if error:
+            errors.append(error)
+            logger.error("Error loading '%s' from the API: %s" % (name, error))
+        else:
+            results[name] = result
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+def _load_in_greenlet(name, kwargs, timeout):
+    """ Run a single load for load_many_from_api, returning a (result, error) tuple.
+    """
+    try:
+        with gevent.Timeout(timeout, ApiException(504, "Timed out loading %s." % name)):
+            return load_from_api(**kwargs), None
+    except HTTPException as e:
+        return None, e
+    except Exception as e:
+        logger.error("Error loading '%s' from the API" % name, exc_info=e)
+        return None, e
+
+
+def api_request(url, headers, params=None):
+    """ Make a GET request to the API, either in-process or over HTTP,
+    depending on API_IN_PROCESS.
+
+    :return: a (status code, data) tuple. Data is None if the response
+             was an error that isn't JSON.
+    """
+    if API_IN_PROCESS:
+        return in_process_request(url, headers, params)
+    return http_request(url, headers, params)
+
+
+def http_request(url, headers, params=None):
+    response = http.request('GET', url, headers=headers, fields=params)
+
+    if response.status == 404:
+        return response.status, None
+
+    try:
+        data = response_json(response)
+    except ValueError:
+        if response.status in [200, 401, 403]:
+            raise
+        data = None
+
+    return response.status, data
+
+
+def in_process_request(url, headers, params=None):
+    """ Dispatch a request directly to the API view function that serves
+    +url+, without going over the network. The request goes through the same
+    URL routing and token authentication as an HTTP request would, but the
+    view's data is returned as-is, without being encoded to JSON and parsed
+    again.
+    """
+    for i in xrange(MAX_IN_PROCESS_REDIRECTS):
+        parts = urlparse.urlsplit(url)
+        base_url = '%s://%s/' % (parts.scheme, parts.netloc)
+        query_string = params if params else parts.query
+
+        with app.test_request_context(parts.path, base_url=base_url, query_string=query_string,
+                                      headers=headers, environ_overrides={IN_PROCESS_ENVIRON_KEY: True}):
+            try:
+                response = app.make_response(app.dispatch_request())
+            except RequestRedirect as e:
+                url, params = e.new_url, None
+                continue
+            except HTTPException as e:
+                return e.code, {'message': e.description}
+            except Exception as e:
+                logger.error("Error handling in-process API request for %s: %s" % (url, e), exc_info=e)
+                return 500, None
+
+            return response.status_code, response_data(response)
+
+    return 500, {'message': "Too many redirects."}
+
+
+def response_data(response):
+    """ Data from an in-process response. """
+    if isinstance(response.response, LazyJSON):
+        return to_jsonable(response.response.data)
+
+    try:
+        return json.loads(response.get_data(as_text=True))
+    except ValueError:
+        if response.status_code in [200, 401, 403]:
+            raise
+        return None
+
+
 def response_json(resp):
     return json.loads(resp.data.decode('utf-8'))
@@ -0,0 +1,222 @@
+"""
+HTTP conditional requests for API and page responses.
+
+Responses carry an ETag and a Last-Modified header, computed with a single
+aggregate query over the rows they're built from: the latest updated_at of
+the rows and of each related table. The ETag also includes the number of
+rows, and the version of the cache tag of each table involved, including
+association tables, which change whenever their rows do (see
+pmg.api.counts). When a client already has the current version, it gets a
+304 Not Modified before anything is loaded, serialized or rendered.
+
+The results of the aggregate query are cached until one of those tables
+changes, so it doesn't run for every response.
+
+Validators are only computed before the response is built when the request
+is conditional. Otherwise they're computed once the response is ready, and
+use the count of rows that the view has already made.
+
+Memoized views skip the early check, so that a 304 is never cached or handed
+to other requests waiting for the same value. Their cached responses keep
+their validators, and are answered with a 304 by :func:`make_conditional`.
+"""
+import calendar
+import hashlib
+import json
+import logging
+from datetime import datetime
+from functools import wraps
+
+from flask import request, abort
+from flask_security import current_user
+from sqlalchemy import func
+from sqlalchemy.sql.util import find_tables
+from werkzeug.http import is_resource_modified
+
+from pmg import app, db, cache, canonical_url
+from pmg.caching import MEMOIZED_ENVIRON_KEY, tag_versions
+from pmg.api.counts import count_query, COUNT_CACHE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# WSGI environ key holding the validators for the current request's response
+VALIDATORS_ENVIRON_KEY = 'pmg.conditional.validators'
+# WSGI environ key holding the query to compute the validators from, once the response is ready
+QUERY_ENVIRON_KEY = 'pmg.conditional.query'
+# WSGI environ key holding the number of rows the view counted
+COUNT_ENVIRON_KEY = 'pmg.conditional.count'
+
+
+def query_validators(query, unfiltered=False, count=None):
+    """ The (etag, last_modified) validators for a response built from the
+    rows of +query+, or None if they don't have an updated_at column.
+
+    +count+ is the number of rows, if the view has already counted them.
+    Otherwise they're counted with :func:`pmg.api.counts.count_query`, which
+    may estimate the count if +unfiltered+ is True.
+    """
+    model = query.column_descriptions[0]['entity']
+    if model is None or not hasattr(model, 'updated_at'):
+        return None
+
+    # responses include related objects
+    related = set()
+    for rel in model.__mapper__.relationships:
+        related.add(rel.mapper.local_table)
+        if rel.secondary is not None:
+            related.add(rel.secondary)
+
+    tables = set(t.name for t in find_tables(query.statement, include_aliases=True))
+    tables.update(t.name for t in related)
+
+    try:
+        versions = tag_versions(sorted('table:' + t for t in tables))
+        key = json.dumps([canonical_url(request), versions])
+        key = 'validators:' + hashlib.md5(key.encode('utf-8')).hexdigest()
+        latest = cache.get(key)
+    except Exception:
+        if app.debug:
+            raise
+        logger.exception("Exception possibly due to cache backend.")
+        versions, key, latest = [], None, None
+
+    if latest is None:
+        latest = latest_changes(query, model, related)
+        if key is not None:
+            try:
+                cache.set(key, latest, timeout=COUNT_CACHE_TIMEOUT)
+            except Exception:
+                if app.debug:
+                    raise
+                logger.exception("Exception possibly due to cache backend.")
+
+    if count is None:
+        count = count_query(query, unfiltered)
+    values = latest + [count] + versions
+
+    last_modified = max([v for v in values if isinstance(v, datetime)] or [None])
+    if last_modified is not None:
+        # HTTP dates are in UTC, and only precise to the second
+        last_modified = datetime.utcfromtimestamp(calendar.timegm(last_modified.utctimetuple()))
+
+    # responses with restricted content differ by user
+    user_id = current_user.get_id() if current_user.is_authenticated() else None
+    key = json.dumps([canonical_url(request), [unicode(v) for v in values], user_id])
+    etag = hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    return etag, last_modified
+
+
+def latest_changes(query, model, related):
+    """ The latest updated_at of the rows of +query+, and the latest
+    updated_at (or id, for tables without one) of each of the +related+ tables.
+    """
+    rows = query\
+        .enable_eagerloads(False)\
+        .order_by(None)\
+        .with_entities(model.updated_at.label('updated_at'))\
+        .subquery()
+    columns = [func.max(rows.c.updated_at)]
+
+    for table in sorted(related, key=lambda t: t.name):
+        column = table.c.get('updated_at', table.c.get('id'))
+        if column is not None:
+            columns.append(db.session.query(func.max(column)).as_scalar())
+
+    return list(db.session.query(*columns).select_from(rows).one())
+
+
+def check_not_modified(query, unfiltered=False):
+    """ Compute the validators for a response built from +query+, and abort
+    with 304 Not Modified if the client already has that version. Otherwise
+    they're added to the response by :func:`set_validators`.
+
+    +unfiltered+ is passed on to :func:`query_validators`. Requests dispatched
+    in-process by pmg.api.client are ignored.
+    """
+    from pmg.api.v1 import is_in_process_request
+
+    if is_in_process_request():
+        return
+
+    if not is_conditional_request():
+        request.environ[QUERY_ENVIRON_KEY] = (query, unfiltered)
+        return
+
+    validators = query_validators(query, unfiltered)
+    if validators is None:
+        return
+
+    request.environ[VALIDATORS_ENVIRON_KEY] = validators
+    if request.environ.get(MEMOIZED_ENVIRON_KEY):
+        return
+
+    etag, last_modified = validators
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(status=304)
+        abort(set_validators(response))
+
+
+def is_conditional_request():
+    return 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers
+
+
+def remember_count(count):
+    """ Remember the number of rows that the current request's view counted,
+    so that the validators don't count them again.
+    """
+    if count is not None:
+        request.environ[COUNT_ENVIRON_KEY] = count
+
+
+def set_validators(response):
+    """ Add the validators for the current request, if any, to +response+. """
+    pending = request.environ.pop(QUERY_ENVIRON_KEY, None)
+    if pending is not None and response.status_code == 200:
+        query, unfiltered = pending
+        request.environ[VALIDATORS_ENVIRON_KEY] = query_validators(
+            query, unfiltered, count=request.environ.get(COUNT_ENVIRON_KEY))
+
+    validators = request.environ.get(VALIDATORS_ENVIRON_KEY)
+    if validators and response.status_code in (200, 304):
+        etag, last_modified = validators
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        # clients must check that their copy is current before using it
+        response.cache_control.no_cache = True
+        if current_user.is_authenticated():
+            response.cache_control.private = True
+    return response
+
+
+def conditional(query):
+    """ Answer requests for a page with 304 Not Modified if its rows haven't
+    changed. +query+ is called with the view's arguments, and returns a query
+    for those rows.
+
+    Only applies to anonymous users, since pages for logged in users include
+    details, such as the committees they follow, that aren't in the query.
+    """
+    def wrapper(fn):
+        @wraps(fn)
+        def decorated_view(*args, **kwargs):
+            if not current_user.is_anonymous():
+                return fn(*args, **kwargs)
+
+            check_not_modified(query(**kwargs))
+            return set_validators(app.make_response(fn(*args, **kwargs)))
+        return decorated_view
+    return wrapper
+
+
+@app.after_request
+def make_conditional(response):
+    """ Answer requests with 304 Not Modified if they match the validators
+    of a cached response.
+    """
+    from pmg.api.v1 import is_in_process_request
+
+    if response.status_code == 200 and 'ETag' in response.headers and not is_in_process_request():
+        response.make_conditional(request)
+    return response
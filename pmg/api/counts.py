@@ -0,0 +1,120 @@
+"""
+Cached counts for paginated API lists.
+
+Counting a list means running COUNT(*) over the entire filtered query, which
+is often slower than fetching the page itself. Counts are cached per endpoint
+and request params, and are tagged with each table in the query. When a model
+is committed, its tables are invalidated, so counts that depend on it are no
+longer found in the cache.
+"""
+import hashlib
+import json
+import logging
+
+from flask import request
+from flask_sqlalchemy import models_committed
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.sql.util import find_tables
+
+from pmg import app, db, cache
+from pmg.caching import tag_versions, invalidate_tags
+
+logger = logging.getLogger(__name__)
+
+# Counts are invalidated when their tables change, so they can live a long time
+COUNT_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# Request params that don't change the number of items in a list
+UNCOUNTED_PARAMS = set(['page', 'per_page', 'fields', 'cursor', 'count'])
+
+
+class Explain(Executable, ClauseElement):
+    """ EXPLAIN a statement, returning the plan as JSON. """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+def count_query(query, unfiltered=False):
+    """ Count the items in +query+, which serves the current request.
+
+    Counts are cached until a table in the query changes. If the caller
+    knows that +query+ is an unfiltered list, and says so with +unfiltered+,
+    PostgreSQL's planner estimate is used instead of an exact count if it
+    is at least API_COUNT_ESTIMATE_THRESHOLD rows.
+
+    If the cache isn't available, the items are counted without it.
+    """
+    tables = set(t.name for t in find_tables(query.statement, include_aliases=True))
+    try:
+        key = count_cache_key(sorted('table:' + t for t in tables), unfiltered)
+        count = cache.get(key)
+    except Exception:
+        if app.debug:
+            raise
+        logger.exception("Exception possibly due to cache backend.")
+        key = count = None
+
+    if count is None:
+        count = (unfiltered and estimate_count(query)) or query.count()
+        if key is not None:
+            try:
+                cache.set(key, count, timeout=COUNT_CACHE_TIMEOUT)
+            except Exception:
+                if app.debug:
+                    raise
+                logger.exception("Exception possibly due to cache backend.")
+
+    return count
+
+
+def count_cache_key(tags, estimated):
+    params = sorted((k, v) for k, v in request.args.iteritems(multi=True) if k not in UNCOUNTED_PARAMS)
+    view_args = sorted((request.view_args or {}).iteritems())
+    key = json.dumps([request.endpoint, view_args, params, estimated, tag_versions(tags)])
+    return 'api-count:' + hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def is_unfiltered(query):
+    """ Does +query+ list every row of its model? This includes filters added
+    by views, as well as those from the request.
+    """
+    return query.whereclause is None
+
+
+def estimate_count(query):
+    """ PostgreSQL's estimate of the number of rows in +query+ if it is at
+    least API_COUNT_ESTIMATE_THRESHOLD, otherwise None. Only use this for
+    unfiltered lists.
+    """
+    threshold = app.config['API_COUNT_ESTIMATE_THRESHOLD']
+    if not threshold:
+        return None
+
+    statement = query.enable_eagerloads(False).order_by(None).statement
+    plan = db.session.execute(Explain(statement)).scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+
+    if estimate >= threshold:
+        return estimate
+    return None
+
+
+@models_committed.connect_via(app)
+def invalidate_counts(sender, changes):
+    tables = set()
+    for obj, change in changes:
+        # obj is the changed object, change is one of: update, insert, delete
+        tables.update(t.name for t in obj.__mapper__.tables)
+        # association tables have no models of their own, and change along
+        # with the objects whose relationships use them
+        tables.update(rel.secondary.name for rel in obj.__mapper__.relationships if rel.secondary is not None)
+
+    invalidate_tags(['table:' + t for t in tables])
@@ -8,6 +8,39 @@ from pmg.models import (Committee, House, CommitteeMeeting, CommitteeMeetingAtte
 from pmg.utils import externalise_url
 
 
+# Bound schema instances, keyed by (schema class, only fields, many)
+_schema_cache = {}
+# Field selections come from request params, so don't let the cache grow forever
+SCHEMA_CACHE_SIZE = 256
+
+
+def cached_schema(schema_class, only=None, many=False):
+    """ Return a schema instance that dumps +only+ the given fields, reusing
+    instances so that schemas and their nested schemas are only built and
+    introspected once for each field selection.
+    """
+    key = (schema_class, frozenset(only) if only else None, many)
+    schema = _schema_cache.get(key)
+
+    if schema is None:
+        if len(_schema_cache) >= SCHEMA_CACHE_SIZE:
+            _schema_cache.clear()
+
+        schema = schema_class(many=many, only=only)
+        bind_nested_schemas(schema)
+        _schema_cache[key] = schema
+
+    return schema
+
+
+def bind_nested_schemas(schema):
+    """ Nested schemas are built on their first use, build them now instead.
+    """
+    for field in schema.fields.itervalues():
+        if isinstance(field, fields.Nested):
+            bind_nested_schemas(field.schema)
+
+
 def choose_event_schema(base, parent):
     """ Return the schema to use for Event-based objects.
     """
@@ -3,30 +3,38 @@ from functools import wraps
 from itertools import groupby
 import re
 import math
+import json
+import base64
 
 import flask
 from flask import request, redirect, url_for, Blueprint, make_response
 from flask_security import current_user
 from flask_security.decorators import _check_token, _check_http_auth
 from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import wrap_file
 from sqlalchemy import desc
 from sqlalchemy.orm import lazyload, joinedload
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql.expression import literal_column
-from sqlalchemy import or_
+from sqlalchemy.sql.expression import literal_column, literal, tuple_
+from sqlalchemy import or_, and_
 
-from pmg import db, app, cache, cache_key, should_skip_cache
+from pmg import db, app, cache, cache_key, should_skip_cache, LONG_CACHE_TIMEOUT
 from pmg.search import Search
 from pmg.models import *  # noqa
 from pmg.models.base import resource_slugs
 from pmg.admin.xlsx import XLSXBuilder
 import pmg.models.serializers as serializers
 from pmg.utils import externalise_url
+from pmg.api.counts import count_query, is_unfiltered
+from pmg.api.conditional import check_not_modified, set_validators, remember_count
 
 logger = logging.getLogger(__name__)
 
 api = Blueprint('api', __name__)
 
+# WSGI environ key marking requests dispatched in-process by pmg.api.client
+IN_PROCESS_ENVIRON_KEY = 'pmg.api.in_process'
+
 
 def load_user():
     login_mechanisms = {
@@ -91,8 +99,10 @@ def get_filters():
 
 
 def api_resource(resource_id, base_query):
+    query = base_query.filter_by(id=resource_id)
+    check_not_modified(query)
     try:
-        resource = base_query.filter_by(id=resource_id).one()
+        resource = query.one()
     except NoResultFound:
         raise ApiException(404, "Not found")
 
@@ -107,25 +117,128 @@ def api_resource(resource_id, base_query):
     return send_api_response(serializers.queryset_to_json(resource), status_code=status_code)
 
 
-def paginate_request_query(base_query):
+def paginate_request_query(base_query, allow_cursor=False, unfiltered=False):
+    """
+    Paginate +base_query+ based on the request's page and per_page params.
+
+    If +allow_cursor+ is True and the request has a cursor param, use cursor
+    pagination instead. See :func:`paginate_request_query_by_cursor`.
+
+    If +unfiltered+ is True, +base_query+ lists every row of its model, and
+    the count may be an estimate. See :func:`pmg.api.counts.count_query`.
+    """
     per_page = app.config['RESULTS_PER_PAGE_V2'] if request.endpoint.startswith('api2') else app.config['RESULTS_PER_PAGE']
     try:
         per_page = max(min(per_page, int(request.args.get('per_page', per_page))), 1)
     except ValueError:
         pass
 
+    if allow_cursor and 'cursor' in request.args:
+        return paginate_request_query_by_cursor(base_query, per_page, unfiltered)
+
     try:
         page = int(request.args.get('page', 0))
     except ValueError:
         raise ApiException(422, "Please specify a valid 'page'.")
 
     query = base_query.limit(per_page).offset(page * per_page).all()
-    count = base_query.count()
+    count = count_query(base_query, unfiltered)
+    remember_count(count)
     next = create_next_page_url(count, page, per_page)
 
     return query, count, next
 
 
+def paginate_request_query_by_cursor(base_query, per_page, unfiltered=False):
+    """
+    Paginate +base_query+ using keyset pagination. Instead of an offset,
+    each page starts after the sort key of the last item of the previous page,
+    which is passed around as an opaque cursor. Items are ordered by the
+    model's cursor_columns, newest first. This doesn't slow down deeper into
+    the list, unlike an offset.
+
+    The total count is only calculated if the count=true param is given.
+    """
+    if base_query._distinct:
+        raise ApiException(422, "Cursor pagination isn't supported for this list.")
+
+    model = base_query._entity_zero().entity_zero.entity
+    columns = [getattr(model, c) for c in getattr(model, 'cursor_columns', ('id',))]
+    nullable = [c.property.columns[0].nullable for c in columns]
+
+    # NULLs sort first in descending order, so put them last instead, after the oldest items
+    query = base_query.order_by(None).order_by(*[desc(c).nullslast() if n else desc(c) for c, n in zip(columns, nullable)])
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(columns):
+            raise ApiException(422, "Please specify a valid 'cursor'.")
+        if any(nullable):
+            query = query.filter(after_cursor(columns, nullable, values))
+        else:
+            query = query.filter(tuple_(*columns) < tuple_(*[literal(v, c.type) for c, v in zip(columns, values)]))
+
+    # get one extra item to find out if there's a next page
+    items = query.limit(per_page + 1).all()
+    next = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next = create_next_cursor_url(encode_cursor([getattr(items[-1], c.key) for c in columns]))
+
+    count = count_query(base_query, unfiltered) if request.args.get('count') == 'true' else None
+    remember_count(count)
+
+    return items, count, next
+
+
+def after_cursor(columns, nullable, values):
+    """
+    A filter for the items that come after the cursor +values+ of +columns+,
+    newest first, with NULLs last. +nullable+ says which columns may be NULL.
+    Comparing tuples of columns can't be used when the columns may be NULL,
+    since a comparison with NULL is never true.
+    """
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        # the columns before this one are equal to the cursor's values
+        equal = [c.is_(None) if v is None else c == literal(v, c.type) for c, v in zip(columns[:i], values[:i])]
+        # nothing comes after a NULL, other than in the next columns
+        if value is not None:
+            after = column < literal(value, column.type)
+            if nullable[i]:
+                after = or_(after, column.is_(None))
+            clauses.append(and_(*(equal + [after])))
+    return or_(*clauses)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(serializers.to_json(values))
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ApiException(422, "Please specify a valid 'cursor'.")
+
+    if not isinstance(values, list):
+        raise ApiException(422, "Please specify a valid 'cursor'.")
+
+    return values
+
+
+def create_next_cursor_url(cursor):
+    """
+    Generate the URL for the page after +cursor+ for the current request.
+    """
+    args = request.args.to_dict()
+    args.update(request.view_args)
+    args.pop('page', None)
+    args['cursor'] = cursor
+    return externalise_url(url_for(request.endpoint, _external=True, **args))
+
+
 def create_next_page_url(count, page, per_page):
     """
     Generate the next page URL for the current request and
@@ -148,20 +261,38 @@ def api_resource_list(base_query, filters=None):
     for f in filters:
         base_query = base_query.filter_by(**f)
 
-    queryset, count, next = paginate_request_query(base_query)
+    unfiltered = is_unfiltered(base_query)
+    check_not_modified(base_query, unfiltered)
+    queryset, count, next = paginate_request_query(base_query, allow_cursor=True, unfiltered=unfiltered)
 
     out = serializers.queryset_to_json(queryset, count=count, next=next)
     return send_api_response(out)
 
 
+def is_in_process_request():
+    """
+    Is this request being dispatched directly by pmg.api.client, rather
+    than over HTTP?
+    """
+    return request.environ.get(IN_PROCESS_ENVIRON_KEY, False)
+
+
 def send_api_response(data, status_code=200):
-    response = flask.make_response(serializers.to_json(data))
+    if is_in_process_request():
+        # in-process callers read the data directly, it's only encoded if
+        # the response is cached
+        response = app.response_class(serializers.LazyJSON(data))
+    else:
+        response = flask.make_response(serializers.to_json_fast(data))
     response.headers['Access-Control-Allow-Origin'] = "*"
     response.headers['Content-Type'] = "application/json"
     response.status_code = status_code
-    return response
+    return set_validators(response)
 
 
+# rows to read at a time when building large spreadsheets
+XLSX_BATCH_SIZE = 1000
+
 # This is a temporary fix to only show attendance for members
 # of the three major parties until we determine how to present
 # faulty passed records for alternate members
@@ -238,7 +369,7 @@ def user():
 
 
 @api.route('/search/')
-@cache.memoize(make_name=lambda fname: cache_key(request))
+@cache.memoize(timeout=LONG_CACHE_TIMEOUT, make_name=lambda fname: cache_key(request, tags=['search']))
 def search():
     """
     Search through ElasticSearch
@@ -357,10 +488,22 @@ def hansard_list():
     return api_resource_list(query, filters=hansard_filters)
 
 
+def resource_cache_tags():
+    """ Cache tags for the generic resource endpoints. Resources include their
+    related objects, so depend on all of their models.
+    """
+    model = resource_slugs.get(request.view_args['resource'])
+    if not model:
+        return []
+    return ['model:' + model.__name__] + \
+        ['model:' + r.mapper.class_.__name__ for r in model.__mapper__.relationships]
+
+
 @api.route('/<string:resource>/', )
 @api.route('/<string:resource>/<int:resource_id>/', )
 @load_user()
-@cache.memoize(make_name=lambda fname: cache_key(request),
+@cache.memoize(timeout=LONG_CACHE_TIMEOUT,
+               make_name=lambda fname: cache_key(request, tags=resource_cache_tags),
                unless=lambda: should_skip_cache(request, current_user))
 def resource_list(resource, resource_id=None):
     """
@@ -391,7 +534,8 @@ def member_questions(member_id):
 
 
 @api.route('/member/<int:member_id>/attendance/')
-@cache.memoize(make_name=lambda fname: cache_key(request),
+@cache.memoize(timeout=LONG_CACHE_TIMEOUT,
+               make_name=lambda fname: cache_key(request, tags=['Member:{member_id}', 'model:Event']),
                unless=lambda: should_skip_cache(request, current_user))
 def member_attendance(member_id):
     """
@@ -521,21 +665,20 @@ def committee_meeting_attendance_summary():
     """
     sphere = get_attendance_sphere(request)
 
-    rows = CommitteeMeetingAttendance.summary()
+    codes = sorted(CommitteeMeetingAttendance.ATTENDANCE_CODES.keys())
+    rows = MemberAttendanceStats.pivot()
     members = {m.id: m for m in get_attendance_members(sphere)}
 
     data = []
-    for year, year_rows in groupby(rows, lambda r: int(r.year)):
+    for year, year_rows in groupby(rows, lambda r: r.year):
         summaries = []
 
-        for member_id, member_rows in groupby(year_rows, lambda r: r.member_id):
-            m = members.get(member_id, None)
+        for row in year_rows:
+            m = members.get(row.member_id, None)
             if m:
-                member = build_attendance_member_dict(m)
-
                 summaries.append({
-                    'member': member,
-                    'attendance': {row.attendance: row.cnt for row in member_rows},
+                    'member': build_attendance_member_dict(m),
+                    'attendance': {code: getattr(row, code) for code in codes if getattr(row, code)},
                 })
 
         data.append({
@@ -587,45 +730,33 @@ def committee_meeting_attendance_download():
     Download committee meeting attendance data in raw form.
     """
     period = request.args.get("period", None)
-    builder = XLSXBuilder()
-    output, wb = builder.new_workbook()
 
     # attendance summary, by MP
     sphere = get_attendance_sphere(request)
     members = {m.id: m for m in get_attendance_members(sphere)}
     ctes = {c.id: c for c in Committee.list().all()}
-    keys = sorted(CommitteeMeetingAttendance.ATTENDANCE_CODES.keys())
-    rows = [
-        ["year", "member", "party", "committee", "house", "ad-hoc"]
-        + [CommitteeMeetingAttendance.ATTENDANCE_CODES[k] for k in keys]
-    ]
-    raw_data = CommitteeMeetingAttendance.summary(period)
-
-    for grp, group in groupby(
-        raw_data, lambda r: [r.year, r.member_id, r.committee_id]
-    ):
-        year, member_id, cte_id = grp
-        member = members.get(member_id, None)
-        cte = ctes[cte_id]
-        # This check can be removed once we return all party members
-        if member:
-            party = member.party.name if member.party else None
-            attendance = {r.attendance: r.cnt for r in group}
-
-            row = [year, member.name, party, cte.name, cte.house.name_short, cte.ad_hoc]
-            row.extend(attendance.get(k, 0) for k in keys)
-            rows.append(row)
-
-    ws = wb.add_worksheet('summary')
-    builder.write_table(ws, rows)
-
-    # all done
+    codes = sorted(CommitteeMeetingAttendance.ATTENDANCE_CODES.keys())
+    keys = ["year", "member", "party", "committee", "house", "ad-hoc"] + \
+        [CommitteeMeetingAttendance.ATTENDANCE_CODES[k] for k in codes]
+
+    def rows():
+        for row in MemberAttendanceStats.pivot(period, by_committee=True).yield_per(XLSX_BATCH_SIZE):
+            member = members.get(row.member_id, None)
+            # This check can be removed once we return all party members
+            if member:
+                cte = ctes[row.committee_id]
+                party = member.party.name if member.party else None
+                yield [row.year, member.name, party, cte.name, cte.house.name_short, cte.ad_hoc] + \
+                    [getattr(row, k) for k in codes]
+
+    # rows are written to a temporary file as they're read, rather than built up in memory
+    builder = XLSXBuilder()
+    output, wb = builder.new_streaming_workbook()
+    builder.write_rows(wb.add_worksheet('summary'), keys, rows())
     wb.close()
     output.seek(0)
 
-    xlsx = output.read()
-
-    resp = make_response(xlsx)
+    resp = app.response_class(wrap_file(request.environ, output), direct_passthrough=True)
     resp.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     resp.headers['Content-Disposition'] = "attachment;filename=committee-attendance.xlsx"
     return resp
@@ -1,17 +1,27 @@
-from flask import request, Blueprint, abort
+from flask import request, Blueprint, abort, Response, stream_with_context
 from flask_security import current_user
-from sqlalchemy import desc
-from sqlalchemy.orm import defer, noload
+from sqlalchemy import desc, Text
+from sqlalchemy.orm import defer, lazyload, subqueryload
 from sqlalchemy.sql.expression import nullslast
 
-from pmg import cache, cache_key, should_skip_cache
+from pmg import cache, cache_key, should_skip_cache, LONG_CACHE_TIMEOUT
 from pmg.models import Committee, CommitteeMeeting, CommitteeMeetingAttendance, CallForComment, Bill
 from pmg.api.v1 import get_filters, paginate_request_query, send_api_response, load_user
+from pmg.api.conditional import check_not_modified
+from pmg.api.counts import is_unfiltered
 from pmg.api.schemas import *  # noqa
+import pmg.models.serializers as serializers
 from pmg.models.resources import event_bills
 
 api = Blueprint('api2', __name__)
 
+# Number of items loaded at a time when exporting
+EXPORT_BATCH_SIZE = 500
+# Computed attributes that schemas dump, and the relationships they're computed from
+COMPUTED_ATTRIBUTES = {
+    'api_files': 'files',
+}
+
 
 def get_api_fields():
     fields = request.args.get('fields') or ''
@@ -46,10 +56,57 @@ def apply_filters(query):
     return query
 
 
+def shape_query(query, schema, load_all=False):
+    """ Only load what's needed to dump the fields requested with the fields param.
+
+    Relationships that aren't requested aren't eagerly loaded (they're still
+    loaded on access, in case a computed field needs them), requested
+    collections are loaded with a single extra query, and text columns that
+    aren't requested are deferred. Other columns are cheap, and may be used
+    by computed fields, so they're always loaded.
+
+    If +load_all+ is True, every relationship that's dumped is loaded with a
+    single extra query, and all fields are dumped if none are requested.
+    This suits dumping many items at once.
+    """
+    fields = get_api_fields()
+    if not fields and not load_all:
+        return query
+
+    declared = schema._declared_fields
+    attrs = set()
+    for name in set(f.split('.')[0] for f in fields or declared):
+        attrs.add(name)
+        field = declared.get(name)
+        if field is not None and field.attribute:
+            attrs.add(field.attribute.split('.')[0])
+    attrs.update(COMPUTED_ATTRIBUTES[a] for a in list(attrs) if a in COMPUTED_ATTRIBUTES)
+
+    mapper = query._entity_zero().mapper
+    options = []
+
+    if fields:
+        for prop in mapper.column_attrs:
+            if prop.key not in attrs and all(isinstance(c.type, Text) for c in prop.columns):
+                options.append(defer(prop.key))
+
+    for prop in mapper.relationships:
+        if prop.key not in attrs:
+            if fields:
+                options.append(lazyload(prop.key))
+        elif (prop.uselist or load_all) and not query._distinct:
+            options.append(subqueryload(prop.key))
+
+    return query.options(*options)
+
+
 def api_list_items(query, schema):
     query = apply_filters(query)
-    queryset, count, next = paginate_request_query(query)
-    results, errors = schema(many=True, only=get_api_fields()).dump(queryset)
+    unfiltered = is_unfiltered(query)
+    check_not_modified(query, unfiltered)
+    query = shape_query(query, schema)
+    queryset, count, next = paginate_request_query(query, allow_cursor=True, unfiltered=unfiltered)
+    results, errors = cached_schema(schema, only=get_api_fields(), many=True).dump(queryset)
     out = {
         'count': count,
         'next': next,
@@ -58,12 +115,44 @@ def api_list_items(query, schema):
     return send_api_response(out)
 
 
+def api_export_items(query, schema):
+    """ Stream every item in +query+ as newline-delimited JSON, one item per line.
+
+    Items are loaded in batches, in id order, each starting after the last
+    id of the previous batch. The relationships of a batch are loaded with
+    one query each, rather than one query per item. Items are serialized as
+    they're loaded, so memory use doesn't depend on the number of items.
+    """
+    query = shape_query(apply_filters(query), schema, load_all=True)
+    model = query._entity_zero().entity_zero.entity
+    query = query.order_by(None).order_by(model.id)
+    dumper = cached_schema(schema, only=get_api_fields())
+
+    def generate():
+        last_id = None
+        while True:
+            batch = query if last_id is None else query.filter(model.id > last_id)
+            items = batch.limit(EXPORT_BATCH_SIZE).all()
+            if not items:
+                break
+
+            for item in items:
+                data, errors = dumper.dump(item)
+                yield serializers.to_json_fast(data) + '\n'
+            last_id = items[-1].id
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Access-Control-Allow-Origin'] = "*"
+    return response
+
+
 def api_get_item(id, model, schema):
-    item = model.query.get(id)
+    check_not_modified(model.query.filter(model.id == id))
+    item = shape_query(model.query, schema).get(id)
     if not item:
         abort(404)
 
-    item, errors = schema(only=get_api_fields()).dump(item)
+    item, errors = cached_schema(schema, only=get_api_fields()).dump(item)
     return send_api_response({'result': item})
 
 
@@ -88,17 +177,6 @@ def committee_meeting_list(id):
         abort(404)
 
     query = CommitteeMeeting.query.filter(CommitteeMeeting.committee == cte).order_by(desc(CommitteeMeeting.date))
-
-    # defer some expensive fields if they're not needed
-    fields = get_api_fields()
-    if fields:
-        for f in ['body', 'summary']:
-            if f not in fields:
-                query = query.options(defer(f))
-
-        if not any(f == 'committee' or f.startswith('committee.') for f in fields):
-            query = query.options(noload('committee'))
-
     return api_list_items(query, CommitteeMeetingSchema)
 
 
@@ -154,7 +232,8 @@ def committee_members(id):
 @api.route('/committee-meetings/')
 @api.route('/committee-meetings/<int:id>')
 @load_user()
-@cache.memoize(make_name=lambda fname: cache_key(request),
+@cache.memoize(timeout=LONG_CACHE_TIMEOUT,
+               make_name=lambda fname: cache_key(request, tags=['model:Event', 'model:Committee', 'model:Bill']),
                unless=lambda: should_skip_cache(request, current_user))
 def committee_meetings(id=None):
     if id:
@@ -164,7 +243,8 @@ def committee_meetings(id=None):
 
 
 @api.route('/committee-meetings/<int:id>/attendance')
-@cache.memoize(make_name=lambda fname: cache_key(request))
+@cache.memoize(timeout=LONG_CACHE_TIMEOUT,
+               make_name=lambda fname: cache_key(request, tags=['Event:{id}', 'model:Member']))
 def committee_meeting_attendance(id):
     item = CommitteeMeeting.query.filter(CommitteeMeeting.id == id).first()
     if not item:
@@ -235,3 +315,27 @@ def daily_schedules(id=None):
         return api_get_item(id, DailySchedule, DailyScheduleSchema)
     else:
         return api_list_items(DailySchedule.list(), DailyScheduleSchema)
+
+
+# Resources that can be exported in full, with their queries and schemas
+EXPORTS = {
+    'committees': (Committee.list, CommitteeSchema),
+    'committee-meetings': (CommitteeMeeting.list, CommitteeMeetingSchema),
+    'minister-questions': (CommitteeQuestion.list, CommitteeQuestionSchema),
+    'minister-questions/legacy': (QuestionReply.list, QuestionReplySchema),
+    'ministers': (Minister.list, MinisterSchema),
+    'members': (Member.list, MemberSchema),
+    'calls-for-comments': (CallForComment.list, CallForCommentSchema),
+    'bills': (Bill.list, BillSchema),
+    'daily-schedules': (DailySchedule.list, DailyScheduleSchema),
+}
+
+
+@api.route('/<path:resource>/export')
+@load_user()
+def export(resource):
+    if resource not in EXPORTS:
+        abort(404)
+
+    query, schema = EXPORTS[resource]
+    return api_export_items(query(), schema)
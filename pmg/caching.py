@@ -0,0 +1,462 @@
+"""
+A two tier cache for pages and API responses.
+
+Every process has a small in-memory LRU cache, which sits in front of a
+cache that all workers and hosts share (redis, or a per-host filesystem
+cache if redis isn't configured). Values are pickled once, and the same
+bytes are kept in both tiers. Each lookup unpickles a fresh copy, so
+callers can't change the cached values.
+
+Local entries are only kept for a short time. A change made through one
+process shows up in the others once their local entries expire.
+
+Entries can depend on tags, such as "Committee:12" or "model:Bill" (see
+pmg.cache_key). Invalidating a tag gives it a new version, and entries
+created with the old version are no longer found. Tag versions are always
+read from the shared cache, so every process sees an invalidation at once.
+
+Memoized functions (see Cache.memoize) keep serving an expired value for
+CACHE_STALE_TIMEOUT seconds more, while a background greenlet refreshes it.
+When there's no value at all, concurrent callers wait for a single caller to
+compute it, rather than all computing it at once.
+
+The busiest pages are kept cached by warm(), which pmg.tasks runs regularly.
+"""
+import cPickle as pickle
+import functools
+import logging
+import uuid
+from collections import Counter, OrderedDict
+from time import time
+
+import gevent
+import gevent.pool
+from gevent.event import AsyncResult
+from flask import copy_current_request_context, has_request_context, request
+from flask_caching import backends, Cache as FlaskCache
+from werkzeug.contrib.cache import BaseCache
+
+logger = logging.getLogger(__name__)
+
+# log cache statistics every this many lookups
+STATS_INTERVAL = 10000
+# prefix for the keys that hold the current version of each tag
+TAG_VERSION_PREFIX = 'tag-version:'
+# timeout for entries that shouldn't expire. Werkzeug's caches don't treat a
+# timeout of 0 as "never": the filesystem and simple caches expire the entry
+# at once, and redis rejects it
+FOREVER = 60 * 60 * 24 * 365
+# WSGI environ key marking requests whose view is memoized, so that its
+# response may be stored and shared with other requests
+MEMOIZED_ENVIRON_KEY = 'pmg.cache.memoized'
+# longest time that computing a memoized value should take
+COMPUTE_TIMEOUT = 60
+# how often to check whether another process has computed a value
+COMPUTE_POLL_INTERVAL = 0.1
+
+
+def tag_versions(tags):
+    """ The current version of each tag in +tags+. A tag without a version
+    gets a new one, so that if versions are evicted from the cache, the
+    entries that relied on them are never used again.
+    """
+    from pmg import cache
+
+    keys = [TAG_VERSION_PREFIX + t for t in tags]
+    versions = cache.get_many(*keys) if keys else []
+
+    new = {}
+    for i, (key, version) in enumerate(zip(keys, versions)):
+        if version is None:
+            versions[i] = new[key] = uuid.uuid4().hex
+
+    if new:
+        cache.set_many(new, timeout=FOREVER)
+
+    return versions
+
+
+def invalidate_tags(tags):
+    """ Invalidate all cache entries that depend on any of +tags+. """
+    from pmg import cache
+
+    if tags:
+        cache.set_many({TAG_VERSION_PREFIX + t: uuid.uuid4().hex for t in tags}, timeout=FOREVER)
+
+
+class LRUCache(object):
+    """ An in-process cache of byte strings that holds at most +max_bytes+,
+    evicting the least recently used entries first.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        # key -> (expires, data), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+
+        if entry[0] < time():
+            self.bytes -= len(entry[1])
+            return None
+
+        # it's now the most recently used
+        self._entries[key] = entry
+        return entry[1]
+
+    def set(self, key, data, timeout):
+        self.delete(key)
+        if len(data) > self.max_bytes:
+            return
+
+        self._entries[key] = (time() + timeout, data)
+        self.bytes += len(data)
+
+        while self.bytes > self.max_bytes:
+            _, (expires, evicted) = self._entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+
+class TieredCache(BaseCache):
+    """ A local LRU cache in front of a +shared+ cache. Values bigger than
+    +max_item_bytes+ once pickled aren't cached at all.
+    """
+    def __init__(self, shared, local_max_bytes=64 * 1024 * 1024, local_timeout=60,
+                 max_item_bytes=2 * 1024 * 1024, default_timeout=300):
+        super(TieredCache, self).__init__(default_timeout)
+        self.shared = shared
+        self.local = LRUCache(local_max_bytes)
+        self.local_timeout = local_timeout
+        self.max_item_bytes = max_item_bytes
+        self.counts = Counter()
+
+    def _keep_locally(self, key):
+        # tag versions are always read from the shared cache, so that
+        # invalidations are seen by every process at once
+        return not key.startswith(TAG_VERSION_PREFIX)
+
+    def _local_timeout(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        # 0 means never expire
+        if timeout == 0:
+            return self.local_timeout
+        return min(timeout, self.local_timeout)
+
+    def _shared_timeout(self, timeout):
+        # 0 means never expire, which the shared backends don't support
+        if timeout == 0:
+            return FOREVER
+        return timeout
+
+    def _dump(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_item_bytes:
+            self.counts['too_large'] += 1
+            logger.warn("Not caching %s, it is %d bytes" % (key, len(data)))
+            return None
+        return data
+
+    def _count(self, kind):
+        self.counts[kind] += 1
+        if sum(self.counts[k] for k in ('local_hits', 'shared_hits', 'misses')) % STATS_INTERVAL == 0:
+            logger.info("Cache stats: %s" % self.stats())
+
+    def stats(self):
+        """ Hit, miss and size statistics for this process. """
+        stats = dict(self.counts)
+        stats.update({
+            'local_entries': len(self.local),
+            'local_bytes': self.local.bytes,
+            'local_evictions': self.local.evictions,
+        })
+        return stats
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        found = [None] * len(keys)
+        missing = []
+
+        for i, key in enumerate(keys):
+            data = self.local.get(key) if self._keep_locally(key) else None
+            if data is None:
+                missing.append(i)
+            else:
+                self._count('local_hits')
+                found[i] = data
+
+        if missing:
+            # fetch everything else from the shared cache at once
+            for i, data in zip(missing, self.shared.get_many(*[keys[i] for i in missing])):
+                if data is None:
+                    self._count('misses')
+                    continue
+                self._count('shared_hits')
+                found[i] = data
+                if self._keep_locally(keys[i]):
+                    self.local.set(keys[i], data, self.local_timeout)
+
+        return [None if data is None else pickle.loads(data) for data in found]
+
+    def set(self, key, value, timeout=None):
+        data = self._dump(key, value)
+        if data is None:
+            # don't leave an older value behind
+            self.delete(key)
+            return False
+
+        if self._keep_locally(key):
+            self.local.set(key, data, self._local_timeout(timeout))
+        return self.shared.set(key, data, self._shared_timeout(timeout))
+
+    def add(self, key, value, timeout=None):
+        data = self._dump(key, value)
+        if data is None:
+            return False
+
+        # some backends (eg. the filesystem) don't notice that an existing
+        # entry has expired when adding, so clear it out first
+        if self.shared.get(key) is None:
+            self.shared.delete(key)
+        if not self.shared.add(key, data, self._shared_timeout(timeout)):
+            return False
+
+        if self._keep_locally(key):
+            self.local.set(key, data, self._local_timeout(timeout))
+        return True
+
+    def set_many(self, mapping, timeout=None):
+        result = True
+        for key, value in mapping.iteritems():
+            result = self.set(key, value, timeout) and result
+        return result
+
+    def delete(self, key):
+        self.local.delete(key)
+        return self.shared.delete(key)
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+        return self.shared.delete_many(*keys)
+
+    def has(self, key):
+        return self.local.get(key) is not None or self.shared.get(key) is not None
+
+    def clear(self):
+        self.local.clear()
+        return self.shared.clear()
+
+
+def tiered(app, config, args, kwargs):
+    """ Flask-Caching backend factory for a TieredCache that shares values through
+    redis if CACHE_REDIS_URL is set, otherwise through the filesystem in CACHE_DIR.
+    """
+    shared_kwargs = {'default_timeout': kwargs['default_timeout']}
+    if config.get('CACHE_REDIS_URL'):
+        shared = backends.redis(app, config, [], shared_kwargs)
+    else:
+        shared = backends.filesystem(app, config, [], shared_kwargs)
+
+    return TieredCache(
+        shared,
+        local_max_bytes=config['CACHE_LOCAL_MAX_BYTES'],
+        local_timeout=config['CACHE_LOCAL_TIMEOUT'],
+        max_item_bytes=config['CACHE_MAX_ITEM_BYTES'],
+        **kwargs)
+
+
+class CacheEntry(object):
+    """ A memoized value, and the time after which it is stale. """
+    def __init__(self, value, fresh_until):
+        self.value = value
+        self.fresh_until = fresh_until
+
+
+class Cache(FlaskCache):
+    """ Flask-Caching's Cache, with a memoize that serves stale values while
+    refreshing them, and coalesces concurrent misses for the same key.
+    """
+    def __init__(self, *args, **kwargs):
+        # key -> AsyncResult for values being computed in this process
+        self._computing = {}
+        super(Cache, self).__init__(*args, **kwargs)
+
+    def memoize(self, timeout=None, make_name=None, unless=None, forced_update=None):
+        """ Like Flask-Caching's memoize, with the same arguments. """
+        base_memoize = super(Cache, self).memoize
+
+        def memoize(f):
+            base = base_memoize(timeout=timeout, make_name=make_name, unless=unless, forced_update=forced_update)(f)
+
+            @functools.wraps(f)
+            def decorated_function(*args, **kwargs):
+                if self._bypass_cache(unless, f, *args, **kwargs):
+                    return f(*args, **kwargs)
+
+                if has_request_context():
+                    request.environ[MEMOIZED_ENVIRON_KEY] = True
+
+                try:
+                    key = decorated_function.make_cache_key(f, *args, **kwargs)
+                    if callable(forced_update) and forced_update() is True:
+                        entry = None
+                    else:
+                        entry = self.cache.get(key)
+                except Exception:
+                    if self.app.debug:
+                        raise
+                    logger.exception("Exception possibly due to cache backend.")
+                    return f(*args, **kwargs)
+
+                compute = functools.partial(f, *args, **kwargs)
+                if isinstance(entry, CacheEntry):
+                    if entry.fresh_until < time():
+                        self._refresh(key, compute, decorated_function.cache_timeout)
+                    return entry.value
+
+                return self._compute(key, compute, decorated_function.cache_timeout)
+
+            decorated_function.uncached = base.uncached
+            decorated_function.cache_timeout = base.cache_timeout
+            decorated_function.make_cache_key = base.make_cache_key
+            decorated_function.delete_memoized = base.delete_memoized
+            return decorated_function
+        return memoize
+
+    def _store(self, key, value, timeout):
+        if timeout is None:
+            timeout = self.cache.default_timeout
+
+        if timeout == 0:
+            # never expires, so never stale
+            entry, store_timeout = CacheEntry(value, float('inf')), FOREVER
+        else:
+            entry = CacheEntry(value, time() + timeout)
+            store_timeout = timeout + self.app.config['CACHE_STALE_TIMEOUT']
+
+        try:
+            self.cache.set(key, entry, timeout=store_timeout)
+        except Exception:
+            if self.app.debug:
+                raise
+            logger.exception("Exception possibly due to cache backend.")
+
+    def _compute(self, key, compute, timeout):
+        """ Compute and store the value for +key+, unless this process or
+        another one is already doing so, in which case wait for it.
+        """
+        pending = self._computing.get(key)
+        if pending is not None:
+            try:
+                return pending.get(timeout=COMPUTE_TIMEOUT)
+            except gevent.Timeout:
+                return compute()
+
+        pending = self._computing[key] = AsyncResult()
+        lock = key + ':lock'
+        locked = False
+        try:
+            value = None
+            locked = self.cache.add(lock, True, timeout=COMPUTE_TIMEOUT)
+            if not locked:
+                value = self._wait_for(key)
+
+            if value is None:
+                value = compute()
+                self._store(key, value, timeout)
+
+            pending.set(value)
+            return value
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            del self._computing[key]
+            if locked:
+                self.cache.delete(lock)
+
+    def _wait_for(self, key):
+        """ Wait for another process to compute the value for +key+. """
+        deadline = time() + COMPUTE_TIMEOUT
+        while time() < deadline:
+            gevent.sleep(COMPUTE_POLL_INTERVAL)
+            entry = self.cache.get(key)
+            if isinstance(entry, CacheEntry):
+                return entry.value
+        return None
+
+    def _refresh(self, key, compute, timeout):
+        """ Refresh the stale value for +key+ in the background, unless
+        another greenlet or process is already doing so.
+        """
+        lock = key + ':refresh'
+        if not self.cache.add(lock, True, timeout=COMPUTE_TIMEOUT):
+            return
+
+        def refresh():
+            try:
+                self._store(key, compute(), timeout)
+            except Exception:
+                logger.exception("Error refreshing cached value for %s" % key)
+            finally:
+                self.cache.delete(lock)
+
+        if has_request_context():
+            refresh = copy_current_request_context(refresh)
+        gevent.spawn(refresh)
+
+
+def warm(urls, concurrency):
+    """ Request each of +urls+ (paths on the frontend host) as an anonymous
+    user, at most +concurrency+ at a time, so that the responses are cached
+    before users ask for them. Returns a list of (url, status, seconds).
+    """
+    from pmg import app
+
+    client = app.test_client(use_cookies=False)
+    base_url = app.config['FRONTEND_HOST']
+
+    def fetch(url):
+        start = time()
+        try:
+            status = client.get(url, base_url=base_url).status_code
+        except Exception:
+            logger.exception("Error warming cache for %s" % url)
+            status = None
+        elapsed = time() - start
+        logger.info("Warmed cache for %s: %s in %.2fs" % (url, status, elapsed))
+        return url, status, elapsed
+
+    start = time()
+    results = gevent.pool.Pool(concurrency).map(fetch, urls)
+
+    if results:
+        slowest = max(results, key=lambda r: r[2])
+        logger.info("Warmed cache for %d urls in %.2fs, slowest was %s in %.2fs" % (
+            len(results), time() - start, slowest[0], slowest[2]))
+
+    failed = [url for url, status, elapsed in results if status != 200]
+    if failed:
+        logger.warn("Failed to warm cache for %s" % ', '.join(failed))
+
+    return results
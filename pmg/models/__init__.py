@@ -4,3 +4,4 @@ from .emails import *
 from .pages import *
 from .posts import *
 from .soundcloud_track import SoundcloudTrack
+from .search_sync import SearchSync, SearchQueue
@@ -18,6 +18,11 @@ class ApiResource(object):
     created_at = db.Column(db.DateTime(timezone=True), index=True, unique=False, nullable=False, server_default=func.now())
     updated_at = db.Column(db.DateTime(timezone=True), index=True, unique=False, nullable=False, server_default=func.now(), onupdate=func.current_timestamp())
 
+    # Columns that order this resource, newest first, when the API pages through
+    # it with a cursor. Together they must be unique. Rows with NULLs come last,
+    # but paging is quicker through columns that aren't nullable.
+    cursor_columns = ('id',)
+
     @property
     def url(self):
         return url_for('index', _external=True) + "%s/%s/" % (self.slug_prefix, self.id)
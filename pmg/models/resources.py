@@ -4,23 +4,27 @@ import datetime
 import logging
 import os
 import re
-import base64
+import hashlib
 import tempfile
 import pytz
 
-from sqlalchemy import desc, func, sql, case, cast, Float, Integer
+from itertools import chain, groupby
+
+from sqlalchemy import desc, func, sql, case, cast, inspect, event, and_, or_, Float, Integer
 from sqlalchemy.sql.expression import nullslast
-from sqlalchemy.orm import backref, joinedload, validates
+from sqlalchemy.orm import attributes, backref, joinedload, validates, Session
+from sqlalchemy.orm.interfaces import MANYTOONE
 
-from flask import url_for
+from flask import url_for, _request_ctx_stack
 from flask_sqlalchemy import models_committed
 from flask_security import current_user
 
 from werkzeug import secure_filename
 from za_parliament_scrapers.questions import QuestionAnswerScraper
 
-from pmg import app, db
-from pmg.utils import levenshtein
+from pmg import app, db, cache
+from pmg.caching import invalidate_tags, tag_versions
+from pmg.utils import levenshtein, pdf_to_text
 
 import serializers
 from .s3_upload import S3Bucket
@@ -151,6 +155,8 @@ class Bill(ApiResource, db.Model):
     place_of_introduction = db.relationship('House')
     versions = db.relationship("BillVersion", backref='bill', cascade='all, delete, delete-orphan')
 
+    cursor_columns = ('year', 'id')
+
     @property
     def code(self):
         if self.type.is_private_member_bill() and self.year >= 2016:
@@ -168,14 +174,11 @@ class Bill(ApiResource, db.Model):
 
     @property
     def latest_version_for_indexing(self):
-        """ ElasticSearch-friendly indexing the version PDFs.
-        See https://github.com/elastic/elasticsearch-mapper-attachments
-        """
+        """ The latest version's file, whose text is indexed. """
         version = self.latest_version
-        if not version:
-            # don't return None
-            return []
-        return base64.encodestring(version.file.get_bytes())
+        if not version or not version.file:
+            return None
+        return version.file
 
     def to_dict(self, include_related=False):
         tmp = serializers.model_to_dict(self, include_related=include_related)
@@ -288,6 +291,47 @@ class File(db.Model):
         key = s3_bucket.bucket.get_key(self.file_path)
         return key.get_contents_as_string()
 
+    def content_hash(self):
+        """ A hash of this file's content, which changes when the content does,
+        or None if the file is missing.
+        """
+        # Ugly hack for local testing
+        if self.file_path.startswith('/tmp/'):
+            if not os.path.exists(self.file_path):
+                return None
+            with open(self.file_path, 'rb') as f:
+                return hashlib.md5(f.read()).hexdigest()
+        # S3's etag, which doesn't need the file to be downloaded
+        key = s3_bucket.bucket.get_key(self.file_path)
+        return key.etag.strip('"') if key else None
+
+    def get_text(self):
+        """ The text in this file if it's a PDF, otherwise an empty string.
+
+        The text is extracted once for each version of the file's content,
+        and is then kept in FileText.
+        """
+        content_hash = self.content_hash()
+        if content_hash is None:
+            logger.warn("Can't extract text from %s, it's missing" % self)
+            return u''
+
+        text = FileText.cached(self.id, content_hash)
+
+        if text is None:
+            text = u''
+            if self.file_mime == 'application/pdf' or self.file_path.lower().endswith('.pdf'):
+                f = self.open()
+                try:
+                    text = pdf_to_text(f)
+                except Exception as e:
+                    logger.warn("Couldn't extract text from %s: %s" % (self, e), exc_info=e)
+                finally:
+                    f.close()
+            FileText.store(self.id, content_hash, text)
+
+        return text
+
     def __str__(self):
         return unicode(self).encode('utf-8')
 
@@ -297,6 +341,34 @@ class File(db.Model):
         return u'%s' % self.file_path
 
 
+class FileText(db.Model):
+    """ Text extracted from a File, for the version of its content with
+    content_hash.
+
+    This is read and written outside of the session, because text is
+    extracted while items are being indexed, part way through reading them.
+    """
+    __tablename__ = "file_text"
+
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), primary_key=True)
+    content_hash = db.Column(db.String(100), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    def cached(cls, file_id, content_hash):
+        """ The text for this version of the file, or None if it hasn't been extracted. """
+        row = db.engine.execute(
+            sql.select([cls.text]).where(and_(cls.file_id == file_id, cls.content_hash == content_hash))
+        ).first()
+        return row[0] if row else None
+
+    @classmethod
+    def store(cls, file_id, content_hash, text):
+        with db.engine.begin() as connection:
+            connection.execute(cls.__table__.delete().where(cls.file_id == file_id))
+            connection.execute(cls.__table__.insert(), file_id=file_id, content_hash=content_hash, text=text)
+
+
 # TODO: change to use normal sqlalchemy events, then set SQLALCHEMY_TRACK_MODIFICATIONS to False in the config
 @models_committed.connect_via(app)
 def delete_file_from_s3(sender, changes):
@@ -350,6 +422,8 @@ class Event(ApiResource, db.Model):
     # optional file attachments
     files = db.relationship('EventFile', lazy=True, cascade="all, delete, delete-orphan")
 
+    cursor_columns = ('date', 'id')
+
     BILL_MENTION_RE = re.compile(u'bill[, ]*\[(B|PMB)\s*(\d+)(\s*[a-z])?[\s–-]+(\d+)', re.IGNORECASE)
 
     def to_dict(self, include_related=False):
@@ -391,6 +465,10 @@ class Event(ApiResource, db.Model):
         return unicode(tmp)
 
 
+# for cursor pagination of events
+db.Index('event_date_id_ix', Event.date, Event.id)
+
+
 event_bills = db.Table(
     'event_bills',
     db.Column('event_id', db.Integer(), db.ForeignKey('event.id', ondelete="CASCADE")),
@@ -426,15 +504,7 @@ class CommitteeMeeting(Event):
             if self.premium_but_free():
                 return True
 
-            # must be authenticated
-            if not current_user.is_authenticated():
-                return False
-
-            if not current_user.is_confirmed():
-                return False
-
-            # check subscription
-            return current_user.subscribed_to_committee(self.committee)
+            return current_user_subscribed_to_committee(self.committee_id)
 
         return True
 
@@ -474,6 +544,27 @@ class CommitteeMeeting(Event):
         return cls.query.order_by(desc(cls.date))
 
 
+def current_user_subscribed_to_committee(committee_id):
+    """ Does the current user have an active subscription to this committee?
+
+    The user's subscriptions are resolved once per request, so that checking
+    many committee meetings doesn't walk the user's and organisation's
+    subscriptions every time.
+    """
+    # must be authenticated and confirmed
+    if not current_user.is_authenticated() or not current_user.is_confirmed():
+        return False
+
+    # cache on the request context, alongside the user itself
+    ctx = _request_ctx_stack.top
+    cached = getattr(ctx, 'subscribed_committee_ids', None)
+    if cached is None or cached[0] != current_user.id:
+        cached = ctx.subscribed_committee_ids = (current_user.id, current_user.subscribed_committee_ids())
+
+    committee_ids = cached[1]
+    return committee_ids is None or committee_id in committee_ids
+
+
 class Hansard(Event):
     __mapper_args__ = {
         'polymorphic_identity': 'plenary'
@@ -861,6 +952,8 @@ class CommitteeQuestion(ApiResource, db.Model):
 
     files = db.relationship("CommitteeQuestionFile", lazy='joined', cascade="all, delete, delete-orphan")
 
+    cursor_columns = ('date', 'id')
+
     # indexes for uniqueness
     __table_args__ = (
         db.UniqueConstraint('date', 'code', name='date_code_ix'),
@@ -1093,6 +1186,8 @@ class CallForComment(ApiResource, db.Model):
     summary = db.Column(db.Text())
     nid = db.Column(db.Integer())
 
+    cursor_columns = ('start_date', 'id')
+
     @property
     def closed(self):
         return self.end_date and self.end_date < datetime.date.today()
@@ -1191,6 +1286,8 @@ class DailySchedule(ApiResource, db.Model):
 
     files = db.relationship("DailyScheduleFile", lazy='joined', cascade="all, delete, delete-orphan")
 
+    cursor_columns = ('start_date', 'id')
+
     def api_files(self):
         return [f.file for f in self.files]
 
@@ -1209,6 +1306,11 @@ class DailyScheduleFile(FileLinkMixin, db.Model):
     file = db.relationship('File', lazy='joined')
 
 
+# attendance ranks depend on these models, see CommitteeMeetingAttendance.annual_attendance_ranks
+RANK_CACHE_TAGS = ['model:CommitteeMeetingAttendance', 'model:Event', 'model:Committee']
+RANK_CACHE_TIMEOUT = 60 * 60 * 24
+
+
 class CommitteeMeetingAttendance(ApiResource, db.Model):
     __tablename__ = "committee_meeting_attendance"
     """
@@ -1255,37 +1357,32 @@ class CommitteeMeetingAttendance(ApiResource, db.Model):
     def list(cls):
         return cls.query.join(CommitteeMeeting).order_by(CommitteeMeeting.date.desc())
 
+    @classmethod
+    def recorded_period(cls):
+        """ SQL expression for the period in which attendance was recorded:
+        'historical' (before the 2019 parliament), 'current', or 'other'.
+        """
+        return case([
+            (cls.created_at <= '2019-06-30', 'historical'),
+            (cls.created_at >= '2019-07-01', 'current'),
+        ], else_='other')
+
     @classmethod
     def summary(cls, period=None):
         """ Summary of attendance by year, member and committee.
         """
-        year = func.date_part("year", CommitteeMeeting.date).label("year")
-
-        rows = (
-            db.session.query(
-                cls.member_id,
-                cls.attendance,
-                year,
-                CommitteeMeeting.committee_id,
-                func.count(1).label("cnt"),
-            )
-            .select_from(cls)
-            .join(CommitteeMeeting)
-            .group_by(
-                cls.member_id, cls.attendance, CommitteeMeeting.committee_id, year
-            )
-        )
-
-        if period == "historical":
-            rows = rows.filter(CommitteeMeetingAttendance.created_at <= "2019-06-30")
-        else:
-            rows = rows.filter(CommitteeMeetingAttendance.created_at >= "2019-07-01")
-
-        rows = rows.order_by(
-            year.desc(), cls.member_id, CommitteeMeeting.committee_id
-        ).all()
+        stats = MemberAttendanceStats
 
-        return rows
+        return db.session.query(
+            stats.member_id,
+            stats.attendance,
+            stats.year,
+            stats.committee_id,
+            stats.n_meetings.label("cnt"),
+        )\
+            .filter(stats.period == ('historical' if period == 'historical' else 'current'))\
+            .order_by(stats.year.desc(), stats.member_id, stats.committee_id, stats.attendance)\
+            .all()
 
     @classmethod
     def meetings_by_member(cls):
@@ -1320,18 +1417,18 @@ class CommitteeMeetingAttendance(ApiResource, db.Model):
             end_date = datetime.datetime(to_year, 12, 31)
 
         # attendance
+        stats = CommitteeMeetingAttendanceStats
         subquery = db.session.query(
-            CommitteeMeeting.committee_id,
+            stats.committee_id,
             House.name_short.label('house'),
-            func.date_part('year', CommitteeMeeting.date).label('year'),
-            func.count(case([(CommitteeMeetingAttendance.attendance.in_(CommitteeMeetingAttendance.ATTENDANCE_CODES_PRESENT), 1)])).label('n_present'),
-            func.count(CommitteeMeetingAttendance.id).label('n_members')
+            func.date_part('year', stats.date).label('year'),
+            func.sum(stats.n_present).label('n_present'),
+            func.sum(stats.n_members).label('n_members')
         )\
-            .join(Committee, Committee.id == CommitteeMeeting.committee_id)\
+            .join(Committee, Committee.id == stats.committee_id)\
             .join(House, House.id == Committee.house_id)\
-            .join(CommitteeMeetingAttendance, CommitteeMeetingAttendance.meeting_id == CommitteeMeeting.id)\
-            .group_by('year', CommitteeMeeting.committee_id, CommitteeMeeting.id, House.name_short)\
-            .filter(CommitteeMeeting.date >= start_date, CommitteeMeeting.date <= end_date)\
+            .group_by('year', stats.committee_id, stats.meeting_id, House.name_short)\
+            .filter(stats.date >= start_date, stats.date <= end_date)\
             .filter(Committee.ad_hoc == False)\
             .subquery('attendance')
 
@@ -1349,52 +1446,230 @@ class CommitteeMeetingAttendance(ApiResource, db.Model):
 
     @classmethod
     def committee_attendence_trends(cls, committee_id, period):
-        query = db.session.query(
-                func.date_part('year', CommitteeMeeting.date).label('year'),
-                func.count(case([(CommitteeMeetingAttendance.attendance.in_(CommitteeMeetingAttendance.ATTENDANCE_CODES_PRESENT), 1)])).label('n_present'),
-                func.count(CommitteeMeetingAttendance.id).label('n_members')
-                )\
-               .group_by('year', CommitteeMeeting.id)\
-               .filter(CommitteeMeeting.committee_id == committee_id)\
-               .filter(CommitteeMeetingAttendance.meeting_id == CommitteeMeeting.id)
-
-        if period == 'current':
-            query = query.filter(
-                CommitteeMeetingAttendance.created_at >= '2019-07-01')
-        else:
-            query = query.filter(
-                CommitteeMeetingAttendance.created_at <= '2019-06-30')
+        stats = CommitteeMeetingAttendanceStats
+        year = func.date_part('year', stats.date).label('year')
 
-        subquery = query.subquery('attendance')
         return db.session.query(
-            subquery.c.year,
+            year,
             func.count(1).label('n_meetings'),
-            func.avg(cast(subquery.c.n_present, Float) / subquery.c.n_members).label('avg_attendance'),
-            cast(func.avg(subquery.c.n_members), Float).label('avg_members')
+            func.avg(cast(stats.n_present, Float) / stats.n_members).label('avg_attendance'),
+            cast(func.avg(stats.n_members), Float).label('avg_members')
         )\
-            .group_by(subquery.c.year)\
-            .order_by(subquery.c.year)\
+            .filter(stats.committee_id == committee_id)\
+            .filter(stats.period == ('current' if period == 'current' else 'historical'))\
+            .group_by('year')\
+            .order_by('year')\
             .all()
 
     @classmethod
-    def annual_attendance_rank_for_committee(cls, committee, year):
-        attendance = cls.annual_attendance_trends(to_year=year)
+    def annual_attendance_ranks(cls):
+        """ Committees ranked by average attendance, for each year and house.
+        Returns a dict from (year, house name) to a dict from committee id to (rank, count).
 
-        # match house
-        attendance = [a for a in attendance if a.house == committee.house.name_short]
+        The ranks are cached until attendance, meetings or committees change.
+        """
+        key = 'attendance-ranks:' + ','.join(tag_versions(RANK_CACHE_TAGS))
+        ranks = cache.get(key)
 
-        attendance.sort(key=lambda r: r.avg_attendance, reverse=True)
-        count = len(attendance)
+        if ranks is None:
+            ranks = {}
+            attendance = cls.annual_attendance_trends(to_year=datetime.date.today().year)
+            attendance = sorted(attendance, key=lambda r: (r.year, r.house))
 
-        for i, att in enumerate(attendance):
-            if att.committee_id == committee.id:
-                return i + 1, count
+            for (year, house), group in groupby(attendance, lambda r: (r.year, r.house)):
+                group = sorted(group, key=lambda r: r.avg_attendance, reverse=True)
+                ranks[(year, house)] = {r.committee_id: (i + 1, len(group)) for i, r in enumerate(group)}
 
-        return None, count
+            cache.set(key, ranks, timeout=RANK_CACHE_TIMEOUT)
+
+        return ranks
+
+    @classmethod
+    def annual_attendance_rank_for_committee(cls, committee, year):
+        """ The (rank, count) of +committee+ amongst the committees in its house
+        in +year+, by average attendance. The rank is None if the committee has
+        no attendance that year.
+        """
+        ranks = cls.annual_attendance_ranks().get((year, committee.house.name_short), {})
+        return ranks.get(committee.id, (None, len(ranks)))
 
 db.Index('meeting_member_ix', CommitteeMeetingAttendance.meeting_id, CommitteeMeetingAttendance.member_id, unique=True)
 
 
+class CommitteeMeetingAttendanceStats(db.Model):
+    """ Attendance counts for each committee meeting, by the period in which the
+    attendance was recorded (see CommitteeMeetingAttendance.recorded_period).
+
+    Kept up to date by update_attendance_stats, so that attendance trends
+    don't need to aggregate every attendance record.
+    """
+    __tablename__ = 'committee_meeting_attendance_stats'
+
+    meeting_id = db.Column(db.Integer, db.ForeignKey('event.id', ondelete='CASCADE'), primary_key=True)
+    period = db.Column(db.String(10), primary_key=True)
+    committee_id = db.Column(db.Integer, db.ForeignKey('committee.id', ondelete='CASCADE'), index=True)
+    date = db.Column(db.DateTime(timezone=True), nullable=False)
+    n_present = db.Column(db.Integer, nullable=False)
+    n_members = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def refresh(cls, connection, meeting_ids):
+        """ Recalculate the stats for +meeting_ids+. """
+        att = CommitteeMeetingAttendance
+        rows = db.session.query(
+            att.meeting_id,
+            att.recorded_period().label('period'),
+            CommitteeMeeting.committee_id,
+            CommitteeMeeting.date,
+            case([(att.attendance.in_(att.ATTENDANCE_CODES_PRESENT), 1)], else_=0).label('present'),
+        )\
+            .join(CommitteeMeeting, CommitteeMeeting.id == att.meeting_id)\
+            .filter(att.meeting_id.in_(meeting_ids))\
+            .subquery()
+
+        stats = db.session.query(
+            rows.c.meeting_id,
+            rows.c.period,
+            rows.c.committee_id,
+            rows.c.date,
+            func.sum(rows.c.present),
+            func.count(1),
+        )\
+            .group_by(rows.c.meeting_id, rows.c.period, rows.c.committee_id, rows.c.date)
+
+        connection.execute(cls.__table__.delete().where(cls.meeting_id.in_(meeting_ids)))
+        connection.execute(cls.__table__.insert().from_select(
+            ['meeting_id', 'period', 'committee_id', 'date', 'n_present', 'n_members'],
+            stats.statement))
+
+
+class MemberAttendanceStats(db.Model):
+    """ The number of committee meetings with each attendance code, for each member,
+    committee, year and period in which the attendance was recorded.
+
+    Kept up to date by update_attendance_stats.
+    """
+    __tablename__ = 'member_attendance_stats'
+
+    member_id = db.Column(db.Integer, db.ForeignKey('member.id', ondelete='CASCADE'), primary_key=True)
+    committee_id = db.Column(db.Integer, db.ForeignKey('committee.id', ondelete='CASCADE'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(10), primary_key=True)
+    attendance = db.Column(db.String(3), primary_key=True)
+    n_meetings = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def pivot(cls, period=None, by_committee=False):
+        """ Attendance for each year and member (and committee, if +by_committee+),
+        with a column for each attendance code giving the number of meetings,
+        newest year first.
+        """
+        codes = sorted(CommitteeMeetingAttendance.ATTENDANCE_CODES.keys())
+        groups = [cls.year, cls.member_id]
+        if by_committee:
+            groups.append(cls.committee_id)
+
+        columns = groups + [
+            func.sum(case([(cls.attendance == code, cls.n_meetings)], else_=0)).label(code)
+            for code in codes]
+
+        return db.session.query(*columns)\
+            .filter(cls.period == ('historical' if period == 'historical' else 'current'))\
+            .group_by(*groups)\
+            .order_by(cls.year.desc(), *groups[1:])
+
+    @classmethod
+    def refresh(cls, connection, committee_years):
+        """ Recalculate the stats for each (committee id, year) in +committee_years+. """
+        att = CommitteeMeetingAttendance
+        year = cast(func.date_part('year', CommitteeMeeting.date), Integer)
+        rows = db.session.query(
+            att.member_id,
+            CommitteeMeeting.committee_id,
+            year.label('year'),
+            att.recorded_period().label('period'),
+            att.attendance,
+        )\
+            .join(CommitteeMeeting, CommitteeMeeting.id == att.meeting_id)\
+            .filter(or_(*[and_(CommitteeMeeting.committee_id == c, year == y) for c, y in committee_years]))\
+            .subquery()
+
+        stats = db.session.query(
+            rows.c.member_id,
+            rows.c.committee_id,
+            rows.c.year,
+            rows.c.period,
+            rows.c.attendance,
+            func.count(1),
+        )\
+            .group_by(rows.c.member_id, rows.c.committee_id, rows.c.year, rows.c.period, rows.c.attendance)
+
+        connection.execute(cls.__table__.delete().where(
+            or_(*[and_(cls.committee_id == c, cls.year == y) for c, y in committee_years])))
+        connection.execute(cls.__table__.insert().from_select(
+            ['member_id', 'committee_id', 'year', 'period', 'attendance', 'n_meetings'],
+            stats.statement))
+
+db.Index('member_attendance_stats_committee_year_ix', MemberAttendanceStats.committee_id, MemberAttendanceStats.year)
+
+
+@event.listens_for(Session, 'before_flush')
+def remember_deleted_attendance(session, flush_context, instances):
+    """ Remember the meetings of deleted attendance and committee meetings for
+    update_attendance_stats, while they can still be loaded. The stats of a
+    deleted meeting are deleted along with it, so also remember its committee
+    and year.
+    """
+    for obj in session.deleted:
+        if isinstance(obj, CommitteeMeetingAttendance):
+            session.info.setdefault('attendance_meeting_ids', set()).add(obj.meeting_id)
+        elif isinstance(obj, CommitteeMeeting):
+            session.info.setdefault('attendance_meeting_ids', set()).add(obj.id)
+            session.info.setdefault('attendance_committee_years', set()).add((obj.committee_id, obj.date.year))
+
+
+@event.listens_for(Session, 'after_flush')
+def update_attendance_stats(session, flush_context):
+    """ Keep the attendance stats up to date as attendance and committee meetings change.
+
+    This runs in the same transaction as the changes, and only recalculates
+    the stats for the meetings that changed, and their committees and years.
+    """
+    meeting_ids = session.info.pop('attendance_meeting_ids', set())
+    committee_years = session.info.pop('attendance_committee_years', set())
+
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, CommitteeMeetingAttendance):
+            meeting_ids.update(inspect(obj).attrs.meeting_id.history.sum())
+            meeting_ids.add(obj.meeting_id)
+
+        elif isinstance(obj, CommitteeMeeting) and obj not in session.new:
+            state = inspect(obj)
+            if state.attrs.date.history.has_changes() or state.attrs.committee_id.history.has_changes():
+                meeting_ids.add(obj.id)
+
+    meeting_ids.discard(None)
+    if not meeting_ids:
+        return
+
+    connection = session.connection()
+    stats = CommitteeMeetingAttendanceStats
+
+    # the committees and years the meetings were in, and are in now
+    year = cast(func.date_part('year', CommitteeMeeting.date), Integer)
+    committee_years.update(tuple(row) for row in connection.execute(
+        db.session.query(stats.committee_id, cast(func.date_part('year', stats.date), Integer))
+        .filter(stats.meeting_id.in_(meeting_ids))
+        .union(db.session.query(CommitteeMeeting.committee_id, year)
+               .filter(CommitteeMeeting.id.in_(meeting_ids)))
+        .statement))
+    committee_years = [(c, y) for c, y in committee_years if c is not None]
+
+    if committee_years:
+        MemberAttendanceStats.refresh(connection, committee_years)
+    stats.refresh(connection, meeting_ids)
+
+
 class Minister(ApiResource, db.Model):
     __tablename__ = "minister"
     """
@@ -1434,35 +1709,141 @@ class Minister(ApiResource, db.Model):
         return best[0] if best else None
 
 
+@event.listens_for(Session, 'after_flush')
+def queue_search_changes(session, flush_context):
+    """ Queue changed items to be reindexed by pmg.tasks.index_search_queue, in
+    the background, so that saving doesn't wait for ElasticSearch, or fail when
+    it's down. Deleted items are also left for the next sync, if that's how the
+    index is kept up to date.
+
+    The queue is written in the same transaction as the changes, so that they
+    are queued if, and only if, they're committed.
+    """
+    from pmg.search import Search
+    from pmg.models.search_sync import SearchQueue
+    searcher = Search()
+    if not searcher.queue_changes and searcher.reindex_changes:
+        return
+
+    objs = [obj for obj in session.new if searcher.indexable(obj, 'insert')]
+    objs.extend(obj for obj in session.dirty if searcher.indexable(obj, 'update') and session.is_modified(obj))
+    objs.extend(obj for obj in session.deleted if searcher.indexable(obj, 'delete'))
+    SearchQueue.enqueue(session.connection(), objs)
+
+
 # Listen for model updates
 @models_committed.connect_via(app)
 def on_models_changed(sender, changes):
     from pmg.search import Search
     searcher = Search()
+    if searcher.queue_changes or not searcher.reindex_changes:
+        # already queued by queue_search_changes
+        return
 
+    # obj is the changed object, change is one of: update, insert, delete
+    changes = [(obj, change) for obj, change in changes if searcher.indexable(obj, change)]
+    if not changes:
+        return
+
+    # nothing drains the queue without periodic tasks, so reindex them now
+    for obj, change in changes:
+        logger.info('Reindexing changed item: %s %s(%s)' % (change, obj.__class__, obj.id))
+
+        if change == 'delete':
+            searcher.delete_obj(obj.__class__, obj.id)
+        else:
+            # NOTE: at this point, the db session is useless since it has already been
+            # committed, so reload the object in a new session.
+            s = db.Session(bind=db.engine)
+            try:
+                searcher.add_obj(s.query(obj.__class__).get(obj.id))
+            finally:
+                s.close()
+
+    # cached search results are now stale
+    invalidate_tags(['search'])
+
+
+def cache_tags(obj):
+    """ Cache tags for the pages and API responses that depend on +obj+: its
+    model types (eg. "model:CommitteeMeeting" and "model:Event"), the object
+    itself (eg. "Event:12") and the objects it refers to (eg. "Committee:3").
+    Objects are identified by the name of their base model.
+    """
+    mapper = obj.__mapper__
+    tags = set('model:' + m.class_.__name__ for m in mapper.iterate_to_root())
+
+    identity = inspect(obj).identity
+    if identity:
+        tags.add('%s:%s' % (mapper.base_mapper.class_.__name__, ','.join(str(i) for i in identity)))
+
+    for rel, key in reference_keys(mapper):
+        value = getattr(obj, key)
+        if value is not None:
+            tags.add('%s:%s' % (rel.mapper.base_mapper.class_.__name__, value))
+
+    # attendance stats are recalculated when attendance and meetings change
+    if isinstance(obj, (CommitteeMeetingAttendance, CommitteeMeeting)):
+        tags.update(['model:CommitteeMeetingAttendanceStats', 'model:MemberAttendanceStats'])
+
+    return tags
+
+
+def previous_cache_tags(obj):
+    """ Cache tags for the objects that +obj+ referred to before its pending
+    changes, eg. the committee a meeting was moved from. This must be called
+    before the changes are flushed.
+    """
+    tags = set()
+    for rel, key in reference_keys(obj.__mapper__):
+        # a relationship that has changed only updates its column when flushed,
+        # so the column still has the previous value
+        history = attributes.get_history(obj, key)
+        for value in chain(history.unchanged or (), history.deleted or ()):
+            if value is not None:
+                tags.add('%s:%s' % (rel.mapper.base_mapper.class_.__name__, value))
+    return tags
+
+
+def reference_keys(mapper):
+    """ The many-to-one relationships of +mapper+ that have a single column,
+    and the attribute key of that column.
+    """
+    for rel in mapper.relationships:
+        if rel.direction is MANYTOONE and len(rel.local_columns) == 1:
+            yield rel, mapper.get_property_by_column(list(rel.local_columns)[0]).key
+
+
+@models_committed.connect_via(app)
+def invalidate_cached_pages(sender, changes):
+    tags = set()
     for obj, change in changes:
         # obj is the changed object, change is one of: update, insert, delete
+        tags.update(cache_tags(obj))
 
-        # NOTE: at this point, the db session is useless since it has already been
-        # committed. Any work we want to do needs to be done in a new session.
+    invalidate_tags(tags)
 
-        if searcher.indexable(obj):
-            logger.info('Reindexing changed item: %s %s(%s)' % (change, obj.__class__, obj.id))
 
-            if change == 'delete':
-                # deleted
-                searcher.delete_obj(obj.__class__, obj.id)
-            else:
-                # updated or inserted
+@event.listens_for(Session, 'before_flush')
+def remember_previous_cache_tags(session, flush_context, instances):
+    """ Remember the objects that changed objects referred to before they
+    changed, so that their pages are invalidated too when the session is
+    committed. Once the changes are flushed, only the new ones are known.
+    """
+    tags = session.info.setdefault('previous_cache_tags', set())
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            tags.update(previous_cache_tags(obj))
 
-                s = db.Session(bind=db.engine)
-                try:
-                    # reload it from the database, because at this point
-                    # the object is stale
-                    obj = s.query(obj.__class__).get(obj.id)
-                    searcher.add_obj(obj)
-                finally:
-                    s.close()
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_previous_cache_tags(session):
+    invalidate_tags(session.info.pop('previous_cache_tags', set()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_previous_cache_tags(session):
+    session.info.pop('previous_cache_tags', None)
 
 # Register all the resource types. This ensures they show up in the API and are searchable
 ApiResource.register(Bill)
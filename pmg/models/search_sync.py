@@ -0,0 +1,59 @@
+from sqlalchemy import func
+
+from pmg import db
+
+
+class SearchSync(db.Model):
+    """
+    How far the search index has been synced with the database, for each
+    search data type. Items of that type updated since synced_at haven't
+    necessarily been indexed yet.
+    """
+    __tablename__ = "search_sync"
+
+    data_type = db.Column(db.String(50), primary_key=True)
+    # the database's time when the last sync started
+    synced_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    def __unicode__(self):
+        return u'<SearchSync %s at %s>' % (self.data_type, self.synced_at)
+
+    @classmethod
+    def watermark(cls, data_type):
+        """ The time that +data_type+ was last synced, or None. """
+        sync = cls.query.get(data_type)
+        return sync.synced_at if sync else None
+
+    @classmethod
+    def mark(cls, data_type, synced_at):
+        """ Record that +data_type+ has been synced with all changes from before +synced_at+. """
+        sync = cls.query.get(data_type) or cls(data_type=data_type)
+        sync.synced_at = synced_at
+        db.session.add(sync)
+        db.session.commit()
+
+
+class SearchQueue(db.Model):
+    """
+    Items that have changed and must be reindexed, or removed from the search
+    index if they no longer exist. The queue is drained by
+    pmg.search.Search.index_queued.
+    """
+    __tablename__ = "search_queue"
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+    slug_prefix = db.Column(db.String(50), nullable=False)
+    model_id = db.Column(db.Integer, nullable=False)
+
+    def __unicode__(self):
+        return u'<SearchQueue %s %s>' % (self.slug_prefix, self.model_id)
+
+    @classmethod
+    def enqueue(cls, connection, objs):
+        """ Queue +objs+ to be reindexed, using +connection+. This doesn't add
+        objects to the session, so it can be called while it's being flushed.
+        """
+        rows = [{'slug_prefix': obj.slug_prefix, 'model_id': obj.id} for obj in objs]
+        if rows:
+            connection.execute(cls.__table__.insert(), rows)
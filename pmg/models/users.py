@@ -131,24 +131,27 @@ class User(db.Model, UserMixin):
 
     def subscribed_to_committee(self, committee):
         """ Does this user have an active subscription to `committee`? """
+        committee_ids = self.subscribed_committee_ids()
+        return committee_ids is None or committee.id in committee_ids
+
+    def subscribed_committee_ids(self):
+        """ The ids of the committees this user has an active subscription to,
+        either directly or through their organisation, or None if they have
+        access to all committees.
+        """
         # admin users have access to everything
         if self.has_role('editor'):
-            return True
+            return None
 
-        # inactive users should go away
-        if not self.active:
-            return False
+        # inactive and expired users should go away
+        if not self.active or self.has_expired():
+            return frozenset()
 
-        # expired users should go away
-        if self.has_expired():
-            return False
+        committee_ids = set(c.id for c in self.subscriptions)
+        if self.organisation and not self.organisation.has_expired():
+            committee_ids.update(c.id for c in self.organisation.subscriptions)
 
-        # first see if this user has a subscription
-        if committee in self.subscriptions:
-            return True
-
-        # now check if our organisation has access
-        return self.organisation and self.organisation.subscribed_to_committee(committee)
+        return frozenset(committee_ids)
 
     def gets_alerts_for(self, committee):
         from ..models.resources import Committee
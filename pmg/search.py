@@ -1,25 +1,40 @@
-import math
 import logging
 import json
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict, deque
 import re
 import copy
-import cPickle
+import multiprocessing
+import threading
+import time
+from datetime import datetime, timedelta
+from Queue import Queue
 
 from pyelasticsearch import ElasticSearch
-from pyelasticsearch.exceptions import ElasticHttpNotFoundError
+from pyelasticsearch.exceptions import ElasticHttpError, ElasticHttpNotFoundError
 import pytz
 
 from bs4 import BeautifulSoup
 
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload_all
+
 from . import db, app
 from pmg.models.resources import *  # noqa
 from pmg.models.base import resource_slugs
+from pmg.models.search_sync import SearchSync, SearchQueue
+from pmg.caching import invalidate_tags
 
 PHRASE_RE = re.compile(r'"([^"]*)("|$)')
 MAX_INDEXABLE_BYTES = 104857600 # Limit ElasticSearch/Netty has by default
 
 class Search:
+    """ Search using ElasticSearch.
+
+    Searches and updates use the index_name alias, which points at a versioned
+    index such as "pmg-20190701120000". A full reindex builds a new versioned
+    index alongside the live one, and then moves the alias over to it in one
+    step, so search is never empty or partial while it runs.
+    """
 
     esserver = app.config['ES_SERVER']
     index_name = "pmg"
@@ -27,11 +42,27 @@ class Search:
     exact_search_fields = ["title.exact^2", "description.exact", "fulltext.exact", "attachments_exact"]
     es = ElasticSearch(esserver)
     per_batch = 200
+    # bulk index requests to have in flight at once while reindexing
+    bulk_concurrency = 4
+    # processes that strip HTML from items while reindexing
+    serialise_processes = multiprocessing.cpu_count()
+    # updated_at is when a row's transaction started, so a sync also indexes
+    # rows updated a little before the last one, to catch slow transactions
+    sync_overlap = timedelta(minutes=5)
     logger = logging.getLogger(__name__)
 
     reindex_changes = app.config['SEARCH_REINDEX_CHANGES']
     """ Should updates to models be reindexed? """
 
+    queue_changes = app.config['RUN_PERIODIC_TASKS']
+    """ Should changed models be queued, for pmg.tasks.index_search_queue to reindex?
+    Otherwise they're reindexed as they're committed. """
+
+    sync_changes = bool(app.config['SEARCH_SYNC_PERIOD_MINUTES'])
+    """ Is the index synced with the database on a schedule? A sync can't find
+    deleted items, so when changes aren't reindexed, deletions are queued for
+    the sync to apply. """
+
     friendly_data_types = OrderedDict([
         ("committee", "Committees"),
         ("committee_meeting", "Committee Meetings"),
@@ -49,49 +80,132 @@ class Search:
     ])
 
     def reindex_all(self, data_type):
-        """ Index all content of a data_type """
-        try:
-            self.drop_index(data_type)
-        except:
-            self.logger.warn("Couldn't find %s index" % data_type)
+        """ Index all content of a data_type.
 
+        Documents are replaced in the live index, so existing documents can
+        still be found until they're replaced. Documents for deleted items
+        are removed afterwards. Use reindex_everything if the mapping has
+        changed.
+        """
+        started = datetime.utcnow()
+        synced_at = self.db_now()
         self.mapping(data_type)
 
-        models = [m for m in resource_slugs.itervalues() if m.resource_content_type == data_type]
-        for model in models:
+        for model in self.models_for(data_type):
             self.reindex_for_model(model)
 
-    def reindex_for_model(self, model):
-        """ Index all content of type +model+ """
-        ids = [r[0] for r in db.session.query(model.id).all()]
+        self.delete_unindexed(data_type, started)
+        SearchSync.mark(data_type, synced_at)
 
-        if model.__name__ == 'Bill':
-            per_batch = 1
-        else:
-            per_batch = self.per_batch
-
-        count = len(ids)
-        pages = int(math.ceil(float(count) / float(per_batch)))
-        self.logger.info("Reindexing for %s" % model.__name__)
-        self.logger.info("Pages %s, %s per page, %s items" % (pages, per_batch, count))
-
-        while len(ids):
-            self.logger.info("Items left %s" % len(ids))
-            id_subsection = []
-            for x in xrange(0, per_batch):
-                if ids:
-                    id_subsection.append(ids.pop())
-
-            rows = db.session.query(model).filter(model.id.in_(id_subsection)).all()
-            items = [Transforms.serialise(r) for r in rows]
-            items = self.filter_too_large(items)
+    def sync(self, data_type):
+        """ Index items of +data_type+ that have changed since it was last synced,
+        and the queued items, which include deleted ones.
+
+        If +data_type+ has never been synced, nothing is done, since all of it
+        must be reindexed first, which takes too long for a scheduled task.
+        Run bin/search.py --reindex to do so.
+        """
+        since = SearchSync.watermark(data_type)
+        if since is None:
+            self.logger.warn("%s has never been synced, reindex it with bin/search.py --reindex first" % data_type)
+            return
+
+        synced_at = self.db_now()
+        models = self.models_for(data_type)
+        for model in models:
+            self.reindex_changed(model, since - self.sync_overlap)
+        self.index_queued(models)
+        SearchSync.mark(data_type, synced_at)
+
+    def sync_all(self):
+        for data_type in Transforms.data_types():
+            self.sync(data_type)
+
+    def models_for(self, data_type):
+        return [m for m in resource_slugs.itervalues() if m.resource_content_type == data_type]
+
+    def db_now(self):
+        """ The database's current time, which updated_at columns are set from. """
+        return db.session.query(func.now()).scalar()
+
+    def reindex_for_model(self, model, index=None):
+        """ Index all content of type +model+ into +index+ (the live index by default).
+
+        This is a pipeline. Batches are read from the database in id order,
+        while a pool of processes strips HTML from earlier batches and
+        extracts the text of their files, and
+        several bulk requests are sent to ElasticSearch at once. Only a few
+        batches wait at each stage, so a slow stage slows down the others
+        rather than letting batches pile up in memory.
+        """
+        self.logger.info("Reindexing for %s, %s per batch" % (model.__name__, self.per_batch))
+        started = time.time()
+        count = 0
+
+        # the workers extract text from files, and must open their own database
+        # connections rather than sharing this process's
+        db.engine.dispose()
+        pool = multiprocessing.Pool(self.serialise_processes)
+        sender = BulkSender(self, model.resource_content_type, index, self.bulk_concurrency)
+        pending = deque()
+
+        def send_oldest():
+            items = self.filter_too_large(pending.popleft().get())
             if items:
-                self.add_many(model.resource_content_type, items)
+                sender.send(items)
+            return len(items)
+
+        try:
+            for rows in self.read_batches(model, self.per_batch):
+                pending.append(pool.apply_async(clean_items, [[Transforms.extract(r) for r in rows]]))
+                if len(pending) > self.serialise_processes * 2:
+                    count += send_oldest()
+                    self.logger.info("Indexed %d %s items" % (count, model.__name__))
+
+            while pending:
+                count += send_oldest()
+            sender.close()
+        finally:
+            pool.terminate()
+            sender.stop()
+
+        elapsed = time.time() - started
+        self.logger.info("Indexed %d %s items in %.1fs (%.1f items/s)" % (
+            count, model.__name__, elapsed, count / elapsed if elapsed else 0))
+
+    def read_batches(self, model, per_batch, since=None):
+        """ Yield lists of +per_batch+ items of type +model+, in id order, with the
+        related objects that they're indexed with. If +since+ is given, only
+        items updated since then are included.
+        """
+        # eager load the relationships in dotted fields, such as committee.house.name
+        fields = []
+        for field in Transforms.convert_rules[model].itervalues():
+            fields.extend(field if isinstance(field, list) else [field])
+        paths = set(f.rsplit('.', 1)[0] for f in fields if '.' in f)
+        query = db.session.query(model).options(*[joinedload_all(p) for p in paths]).order_by(model.id)
+        if since is not None:
+            query = query.filter(model.updated_at >= since)
+
+        last_id = None
+        while True:
+            batch = query
+            if last_id is not None:
+                batch = batch.filter(model.id > last_id)
+            rows = batch.limit(per_batch).all()
+            if not rows:
+                break
+
+            last_id = rows[-1].id
+            yield rows
+            # the rows are no longer needed once they're serialised
+            db.session.expunge_all()
 
     def filter_too_large(self, items):
         ok_items = []
         for item in items:
-            size = len(cPickle.dumps(item))
+            # documents are mostly text, so this is close enough to their size as JSON
+            size = sum(len(v) for v in item.itervalues() if isinstance(v, basestring))
             if size < MAX_INDEXABLE_BYTES:
                 ok_items.append(item)
             else:
@@ -107,21 +221,95 @@ class Search:
         self.es.delete_all(self.index_name, data_type)
         self.logger.info("Dropped %s index" % data_type)
 
+    def delete_unindexed(self, data_type, since):
+        """ Delete documents of +data_type+ that haven't been indexed since +since+ (UTC). """
+        self.logger.info("Deleting %s documents indexed before %s" % (data_type, since))
+        self.es.delete_by_query(self.index_name, data_type, {
+            "query": {
+                "filtered": {
+                    "filter": {
+                        "or": [
+                            {"range": {"indexed_at": {"lt": since.isoformat()}}},
+                            {"missing": {"field": "indexed_at"}},
+                        ]
+                    }
+                }
+            }
+        })
+
+    def index_queued(self, models=None):
+        """ Reindex the items in the SearchQueue, in batches, until it's empty.
+        If +models+ is given, only items of those types are reindexed.
+
+        Items queued more than once in a batch are only indexed once. Entries
+        are only removed from the queue once they have been indexed, so if
+        ElasticSearch can't be reached they're tried again next time.
+        """
+        query = SearchQueue.query.order_by(SearchQueue.id)
+        if models is not None:
+            query = query.filter(SearchQueue.slug_prefix.in_([m.slug_prefix for m in models]))
+
+        count = 0
+        try:
+            while True:
+                entries = query.limit(self.per_batch).all()
+                if not entries:
+                    break
+
+                ids = defaultdict(set)
+                for entry in entries:
+                    ids[entry.slug_prefix].add(entry.model_id)
+                for slug_prefix, model_ids in ids.iteritems():
+                    self.reindex_ids(resource_slugs[slug_prefix], model_ids)
+
+                SearchQueue.query\
+                    .filter(SearchQueue.id.in_([e.id for e in entries]))\
+                    .delete(synchronize_session=False)
+                db.session.commit()
+                count += len(entries)
+        except:
+            db.session.rollback()
+            raise
+        finally:
+            if count:
+                self.logger.info("Indexed %d queued items" % count)
+                # cached search results are now stale
+                invalidate_tags(['search'])
+
+    def reindex_ids(self, model, ids):
+        """ Index the items of type +model+ with +ids+, and delete the documents
+        for those that no longer exist.
+        """
+        ids = sorted(ids)
+
+        for i in xrange(0, len(ids), self.per_batch):
+            batch = ids[i:i + self.per_batch]
+            rows = db.session.query(model).filter(model.id.in_(batch)).all()
+            items = self.filter_too_large([Transforms.serialise(r) for r in rows])
+            if items:
+                self.add_many(model.resource_content_type, items)
+
+            for model_id in set(batch) - set(r.id for r in rows):
+                self.delete_obj(model, model_id)
+
     def add_obj(self, obj):
         self.add(obj.resource_content_type, Transforms.serialise(obj))
 
-    def add_many(self, data_type, items):
-        self.es.bulk_index(self.index_name, data_type, items)
+    def add_many(self, data_type, items, index=None):
+        indexed_at = datetime.utcnow().isoformat()
+        for item in items:
+            item['indexed_at'] = indexed_at
+        self.es.bulk_index(index or self.index_name, data_type, items)
 
     def add(self, data_type, item):
         self.add_many(data_type, [item])
 
     def delete_obj(self, klass, id):
-        self.delete(klass.resource_content_type, id)
+        self.delete(klass.resource_content_type, Transforms.doc_id(klass, id))
 
-    def delete(self, data_type, uid):
+    def delete(self, data_type, uid, index=None):
         try:
-            self.es.delete(self.index_name, data_type, uid)
+            self.es.delete(index or self.index_name, data_type, uid)
         except ElasticHttpNotFoundError:
             pass
 
@@ -131,13 +319,21 @@ class Search:
         except:
             return False
 
-    def indexable(self, obj):
-        """ Should this object be indexed for searching? """
-        return self.reindex_changes and obj.__class__ in Transforms.convert_rules
+    def indexable(self, obj, change='update'):
+        """ Should this +change+ to an object be indexed for searching? """
+        if obj.__class__ not in Transforms.convert_rules:
+            return False
+        if self.reindex_changes:
+            return True
+        # syncs find changed items, but not deleted ones
+        return self.sync_changes and change == 'delete'
 
-    def mapping(self, data_type):
+    def mapping(self, data_type, index=None):
         mapping = {
             "properties": {
+                "indexed_at": {
+                    "type": "date",
+                },
                 "title": {
                     "type": "string",
                     "analyzer": "english",
@@ -187,16 +383,11 @@ class Search:
                     "type": "integer",
                 },
                 "attachments": {
-                    "type": "attachment",
-                    "fields": {
-                        "attachments": {
-                            "type": "string",
-                            "analyzer": "english",
-                            "term_vector": "with_positions_offsets",
-                            "store": "yes",
-                            "copy_to": "attachments_exact",
-                        },
-                    },
+                    "type": "string",
+                    "analyzer": "english",
+                    "term_vector": "with_positions_offsets",
+                    "store": "yes",
+                    "copy_to": "attachments_exact",
                 },
                 "attachments_exact": {
                     "type": "string",
@@ -206,7 +397,13 @@ class Search:
                 },
             }
         }
-        self.es.put_mapping(self.index_name, data_type, mapping)
+        try:
+            self.es.put_mapping(index or self.index_name, data_type, mapping)
+        except ElasticHttpError as e:
+            # existing fields can't be changed, only added
+            self.logger.error("Couldn't update the %s mapping. If it has changed, build a new index "
+                              "with bin/search.py --reindex all: %s" % (data_type, e))
+            raise
 
     def build_filters(self, start_date, end_date, document_type, committee, updated_since, exclude_document_types):
         filters = {}
@@ -396,19 +593,126 @@ class Search:
         return self.es.search(q, index=self.index_name)
 
     def reindex_everything(self):
+        """ Build a new index with all content, and then switch to it. """
         data_types = Transforms.data_types()
+        started = datetime.utcnow()
+        synced_at = self.db_now()
+        index = self.create_index()
 
-        self.logger.info("Reindexing everything: %s" % data_types)
-        self.delete_everything()
-        self.create_index()
+        self.logger.info("Reindexing everything into %s: %s" % (index, data_types))
+        for data_type in data_types:
+            self.mapping(data_type, index)
+            for model in self.models_for(data_type):
+                self.reindex_for_model(model, index)
 
+        # items changed or deleted while the index was being built
+        for model in Transforms.convert_rules.iterkeys():
+            self.reindex_changed(model, started, index)
         for data_type in data_types:
-            self.reindex_all(data_type)
+            self.delete_missing(data_type, index)
+
+        self.swap_index(index)
+        for data_type in data_types:
+            SearchSync.mark(data_type, synced_at)
+
+    def reindex_changed(self, model, since, index=None):
+        """ Index items of type +model+ that have changed since +since+ (UTC, if it's naive). """
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=pytz.utc)
+
+        count = 0
+        for rows in self.read_batches(model, self.per_batch, since):
+            items = self.filter_too_large([Transforms.serialise(r) for r in rows])
+            if items:
+                self.add_many(model.resource_content_type, items, index=index)
+                count += len(items)
+
+        if count:
+            self.logger.info("Indexed %d %s items changed since %s" % (count, model.__name__, since))
+
+    def delete_missing(self, data_type, index=None):
+        """ Delete documents of +data_type+ for items that no longer exist, from +index+
+        (the live index by default).
+        """
+        ids = {}
+        for model in self.models_for(data_type):
+            ids[model.slug_prefix] = set(r[0] for r in db.session.query(model.id))
+
+        missing = []
+        for doc in self.scan(data_type, ['model_id', 'slug_prefix'], index):
+            source = doc.get('_source', {})
+            if source.get('model_id') not in ids.get(source.get('slug_prefix'), ()):
+                missing.append(doc['_id'])
+
+        if missing:
+            self.logger.info("Deleting %d %s documents for deleted items" % (len(missing), data_type))
+            for uid in missing:
+                self.delete(data_type, uid, index)
+
+    def scan(self, data_type, fields, index=None):
+        """ Iterate over all documents of +data_type+ in +index+ (the live index by default),
+        with only +fields+.
+        """
+        query = {
+            "query": {"match_all": {}},
+            "_source": fields,
+            "size": self.per_batch,
+        }
+        params = {'search_type': 'scan', 'scroll': '5m'}
+        result = self.es.send_request('GET', [index or self.index_name, data_type, '_search'], query, query_params=params)
+
+        while True:
+            result = self.es.send_request('GET', ['_search', 'scroll'], result['_scroll_id'],
+                                          query_params={'scroll': '5m'}, encode_body=False)
+            hits = result['hits']['hits']
+            if not hits:
+                break
+            for hit in hits:
+                yield hit
+
+    def swap_index(self, index):
+        """ Point searches and updates at +index+, and delete the index they used before. """
+        old = self.live_indices()
+        actions = [{"add": {"index": index, "alias": self.index_name}}]
+        actions.extend({"remove": {"index": i, "alias": self.index_name}} for i in old)
+
+        if self.index_name in old:
+            # the live index predates versioned indexes, and is called what
+            # the alias will be, so it must be deleted first
+            self.es.delete_index(self.index_name)
+            actions = actions[:1]
+
+        self.logger.info("Switching %s from %s to %s" % (self.index_name, old, index))
+        self.es.update_aliases(actions)
+
+        for i in old:
+            if i != index and i != self.index_name:
+                self.logger.info("Deleting old index %s" % i)
+                self.es.delete_index(i)
+
+    def live_indices(self):
+        """ The names of the indices that searches currently use. """
+        try:
+            return self.es.get_aliases(self.index_name).keys()
+        except ElasticHttpNotFoundError:
+            return []
+
+    def indices(self):
+        """ The names of all versioned indices, oldest first. """
+        try:
+            return sorted(self.es.get_aliases(self.index_name + '-*').keys())
+        except ElasticHttpNotFoundError:
+            return []
 
     def delete_everything(self):
-        self.es.delete_index(self.index_name)
+        for index in set(self.live_indices() + self.indices()):
+            self.es.delete_index(index)
+
+    def create_index(self, index=None):
+        """ Create a new versioned index, and return its name. """
+        if index is None:
+            index = '%s-%s' % (self.index_name, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
 
-    def create_index(self):
         settings = {
             "analysis": {
                 "analyzer": {
@@ -419,7 +723,8 @@ class Search:
                 }
             }
         }
-        self.es.create_index(self.index_name, settings=settings)
+        self.es.create_index(index, settings=settings)
+        return index
 
 
 class Transforms:
@@ -534,8 +839,26 @@ class Transforms:
         },
     }
 
+    @classmethod
+    def doc_id(cls, model, model_id):
+        """ The id of the document for the +model+ item with id +model_id+. """
+        field = cls.convert_rules[model].get('id')
+        if field is None:
+            return model_id
+        # eg. ["slug_prefix", "id"]
+        return ' '.join(unicode(model_id) if f == 'id' else getattr(model, f) for f in field)
+
     @classmethod
     def serialise(cls, obj):
+        return clean_item(cls.extract(obj))
+
+    @classmethod
+    def extract(cls, obj):
+        """ The raw values to index for +obj+, which still need to be cleaned
+        by clean_item. These are plain values, so they can be passed to other
+        processes. Files are described by (id, file_path, file_mime), and
+        their text is extracted by clean_item.
+        """
         item = {
             'model_id': obj.id,
             'url': obj.url,
@@ -550,10 +873,9 @@ class Transforms:
             item['id'] = obj.id
 
         for key, field in rules.iteritems():
-            val = cls.get_val(obj, field)
-            if isinstance(val, unicode):
-                val = BeautifulSoup(val).get_text().strip()
-            item[key] = val
+            item[key] = cls.get_val(obj, field)
+            if key in FILE_TEXT_FIELDS and item[key] is not None:
+                item[key] = (item[key].id, item[key].file_path, item[key].file_mime)
 
         return item
 
@@ -576,3 +898,74 @@ class Transforms:
         else:
             # simple attribute name
             return getattr(obj, field)
+
+
+# fields that hold plain text, such as text extracted from PDFs, rather than HTML
+PLAIN_TEXT_FIELDS = set(['attachments'])
+# fields that hold a File, whose text is indexed
+FILE_TEXT_FIELDS = set(['attachments'])
+
+
+def clean_item(item):
+    """ Extract the text of the files in +item+, and strip HTML from its
+    other text values, in place.
+    """
+    for key, val in item.iteritems():
+        if key in FILE_TEXT_FIELDS and isinstance(val, tuple):
+            file_id, file_path, file_mime = val
+            item[key] = File(id=file_id, file_path=file_path, file_mime=file_mime).get_text()
+        elif isinstance(val, unicode) and key not in PLAIN_TEXT_FIELDS:
+            item[key] = BeautifulSoup(val).get_text().strip()
+    return item
+
+
+def clean_items(items):
+    return [clean_item(item) for item in items]
+
+
+class BulkSender(object):
+    """ Sends batches of items to ElasticSearch using several threads.
+
+    send() blocks while +concurrency+ batches are already waiting, which
+    stops batches piling up in memory when ElasticSearch is slow.
+    """
+
+    def __init__(self, search, data_type, index, concurrency):
+        self.search = search
+        self.data_type = data_type
+        self.index = index
+        self.queue = Queue(maxsize=concurrency)
+        self.error = None
+        self.threads = [threading.Thread(target=self.run) for i in xrange(concurrency)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while True:
+            items = self.queue.get()
+            try:
+                if items is None:
+                    return
+                if self.error is None:
+                    self.search.add_many(self.data_type, items, index=self.index)
+            except Exception as e:
+                self.search.logger.exception("Error sending %s items to ElasticSearch" % self.data_type)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def send(self, items):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(items)
+
+    def close(self):
+        """ Wait for all batches to be sent, raising the first error, if any. """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
@@ -26,6 +26,31 @@ def sync_soundcloud():
         SoundcloudTrack.sync()
 
 
+def warm_cache():
+    from pmg import app
+    from pmg.caching import warm
+    from pmg.models import Committee
+
+    urls = app.config['CACHE_WARM_URLS'] + ['/committee/%d/' % i for i in Committee.POPULAR_COMMITTEES]
+    warm(urls, app.config['CACHE_WARM_CONCURRENCY'])
+
+
+def sync_search():
+    from pmg import app
+    from pmg.search import Search
+
+    with app.app_context():
+        Search().sync_all()
+
+
+def index_search_queue():
+    from pmg import app
+    from pmg.search import Search
+
+    with app.app_context():
+        Search().index_queued()
+
+
 def schedule():
     from pmg import app
     from pmg import scheduler
@@ -41,6 +66,16 @@ def schedule():
         scheduler.add_job(sync_soundcloud, 'cron',
                           id='sync-soundcloud', replace_existing=True,
                           coalesce=True, minute='*/' + app.config['SOUNDCLOUD_PERIOD_MINUTES']),
+        scheduler.add_job(warm_cache, 'cron',
+                          id='warm-cache', replace_existing=True,
+                          coalesce=True, minute='*/' + app.config['CACHE_WARM_PERIOD_MINUTES']),
+        scheduler.add_job(index_search_queue, 'interval',
+                          id='index-search-queue', replace_existing=True,
+                          coalesce=True, seconds=app.config['SEARCH_QUEUE_PERIOD_SECONDS']),
     ]
+    if app.config['SEARCH_SYNC_PERIOD_MINUTES']:
+        jobs.append(scheduler.add_job(sync_search, 'cron',
+                                      id='sync-search', replace_existing=True,
+                                      coalesce=True, minute='*/' + app.config['SEARCH_SYNC_PERIOD_MINUTES']))
     for job in jobs:
         log.info("Scheduled task: %s" % job)
@@ -1,7 +1,12 @@
 from __future__ import division
 import re
+from cStringIO import StringIO
 
 import nltk
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.pdfpage import PDFPage
 from UniversalAnalytics import Tracker
 from flask import request
 from flask_security import current_user
@@ -29,6 +34,20 @@ def levenshtein(first, second, transpositions=False):
     return (lensum - ldist) / lensum
 
 
+def pdf_to_text(f):
+    """ The text in the PDF file +f+, as unicode. Pages are read one at a time. """
+    resources = PDFResourceManager()
+    output = StringIO()
+    device = TextConverter(resources, output, codec='utf-8', laparams=LAParams())
+    try:
+        interpreter = PDFPageInterpreter(resources, device)
+        for page in PDFPage.get_pages(f):
+            interpreter.process_page(page)
+    finally:
+        device.close()
+    return output.getvalue().decode('utf-8')
+
+
 def track_pageview(path=None, ignore_bots=True):
     """ User Google Analytics to track this pageview. """
     from pmg import app
@@ -14,12 +14,13 @@ from flask_mail import Message
 from flask import make_response
 from slugify import slugify
 
-from pmg import app, mail, cache, cache_key, should_skip_cache
+from pmg import app, mail, cache, cache_key, should_skip_cache, LONG_CACHE_TIMEOUT
 from pmg.bills import bill_history, MIN_YEAR
-from pmg.api.client import load_from_api, ApiException
+from pmg.api.client import load_from_api, load_many_from_api, ApiException
 from pmg.api.v1 import create_next_page_url
+from pmg.api.conditional import conditional
 from pmg.search import Search
-from pmg.models import Redirect, Page, Post, SavedSearch, Featured, CommitteeMeeting, CommitteeMeetingAttendance, House
+from pmg.models import Redirect, Page, Post, SavedSearch, Featured, CommitteeMeeting, CommitteeMeetingAttendance, House, Bill
 from pmg.models.resources import Committee
 
 from copy import deepcopy
@@ -152,15 +153,6 @@ def get_featured_content():
     return info
 
 
-@app.context_processor
-def inject_via():
-    # inject the 'via' query param into the page (easier than parsing the querystring in JS)
-    # so that we can track it with GA
-    if request and request.args.get('via'):
-        return {'via_tag': request.args.get('via').strip()}
-    return {'via_tag': None}
-
-
 @app.context_processor
 def inject_free_before_year():
     # inject the year before which premium content is free
@@ -171,7 +163,9 @@ def inject_free_before_year():
 
 @app.route('/')
 @cache.memoize(
-    make_name=lambda fname: cache_key(request),
+    timeout=LONG_CACHE_TIMEOUT,
+    make_name=lambda fname: cache_key(request, tags=[
+        'model:Event', 'model:Committee', 'model:Bill', 'model:CommitteeQuestion', 'model:Post', 'model:Featured']),
     unless=lambda: should_skip_cache(request, current_user))
 def index():
     committee_meetings = load_from_api(
@@ -214,6 +208,10 @@ def bills_explained():
 @app.route(
     "/bills/<any(all, draft, pmb, tabled, 'pmb-committee'):bill_type>/year/<int:year>/"
 )
+@cache.memoize(
+    timeout=LONG_CACHE_TIMEOUT,
+    make_name=lambda fname: cache_key(request, tags=['model:Bill']),
+    unless=lambda: should_skip_cache(request, current_user))
 def bills(bill_type, year=None):
     if bill_type == 'current':
         # don't paginate by year
@@ -264,8 +262,10 @@ def bills(bill_type, year=None):
 
 @app.route('/bill/<int:bill_id>')
 @app.route('/bill/<int:bill_id>/')
+@conditional(lambda bill_id: Bill.query.filter(Bill.id == bill_id))
 @cache.memoize(
-    make_name=lambda fname: cache_key(request),
+    timeout=LONG_CACHE_TIMEOUT,
+    make_name=lambda fname: cache_key(request, tags=['Bill:{bill_id}', 'model:Event', 'model:Committee']),
     unless=lambda: should_skip_cache(request, current_user))
 def bill(bill_id):
     bill = load_from_api('v2/bills', bill_id)['result']
@@ -295,50 +295,100 @@ def bill(bill_id):
         admin_edit_url=admin_url('bill', bill_id))
 
 
+# what the committee detail page depends on
+COMMITTEE_DETAIL_CACHE_TAGS = [
+    'Committee:{committee_id}', 'model:Bill', 'model:CommitteeQuestion', 'model:Member', 'model:Minister',
+    'model:CommitteeMeetingAttendance', 'model:CommitteeMeetingAttendanceStats', 'model:MemberAttendanceStats']
+
+
+def committee_detail_cache_key(fname):
+    # the page also depends on today's date, through the current year and the
+    # meetings of the last six months
+    return '%s|%s' % (cache_key(request, tags=COMMITTEE_DETAIL_CACHE_TAGS), date.today().isoformat())
+
+
 @app.route('/committee/<int:committee_id>')
 @app.route('/committee/<int:committee_id>/')
 @cache.memoize(
-    make_name=lambda fname: cache_key(request),
+    timeout=LONG_CACHE_TIMEOUT,
+    make_name=committee_detail_cache_key,
     unless=lambda: should_skip_cache(request, current_user))
 def committee_detail(committee_id):
     """
     Display all available detail for the committee.
     """
+    # If the request came from a Provincial Committee page,
+    # pass the slug to the template to build the correct breadcrumbs
+    from_page = request.args.get('from_page')
+    return render_template(
+        'committee_detail.html',
+        admin_edit_url=admin_url('committee', committee_id),
+        from_page=from_page,
+        **committee_detail_context(committee_id))
+
+
+@cache.memoize(timeout=LONG_CACHE_TIMEOUT, make_name=committee_detail_cache_key)
+def committee_detail_context(committee_id):
+    """
+    The content of the committee detail page, which is the same for all users.
+    It's cached for logged in users too, who can't use the cached page.
+    """
     committee = load_from_api('v2/committees', committee_id)['result']
     links = committee['_links']
     filtered_meetings = {}
+    minister = committee.get('minister')
+
+    # these are independent of each other, so load them all at once
+    loads = {
+        'calls_for_comments': {
+            'resource_name': links['calls_for_comment'],
+            'fields': ['id', 'title', 'start_date'],
+            'return_everything': True,
+        },
+        'tabled_committee_reports': {
+            'resource_name': links['tabled_reports'],
+            'fields': ['id', 'title', 'start_date'],
+            'return_everything': True,
+        },
+        'membership': {
+            'resource_name': links['members'],
+            'return_everything': True,
+        },
+        'meetings': {
+            'resource_name': links['meetings'],
+            'fields': ['id', 'title', 'date'],
+            'return_everything': True,
+        },
+        'bills': {
+            'resource_name': 'v2/committees/%s/bills' % committee_id,
+            'fields': ['id', 'title', 'status', 'date_of_introduction', 'code'],
+        },
+    }
+    if minister:
+        loads['recent_questions'] = {
+            'resource_name': 'minister-questions-combined',
+            'params': {'filter[minister_id]': minister['id']},
+        }
+    loaded = load_many_from_api(loads)
 
     # calls for comment
-    committee['calls_for_comments'] = load_from_api(
-        links['calls_for_comment'],
-        fields=['id', 'title', 'start_date'],
-        return_everything=True)['results']
+    committee['calls_for_comments'] = loaded['calls_for_comments']['results']
 
     # tabled reports
-    committee['tabled_committee_reports'] = load_from_api(
-        links['tabled_reports'],
-        fields=['id', 'title', 'start_date'],
-        return_everything=True)['results']
+    committee['tabled_committee_reports'] = loaded['tabled_committee_reports']['results']
 
     # memberships
-    membership = load_from_api(
-        links['members'], return_everything=True)['results']
+    membership = loaded['membership']['results']
     sorter = lambda x: x['member']['name']
     membership = sorted([m for m in membership if m['chairperson']], key=sorter) + \
                  sorted([m for m in membership if not m['chairperson']], key=sorter)  # noqa
 
-    minister = committee.get('minister')
     recent_questions = []
     if minister:
-        recent_questions = load_from_api(
-            'minister-questions-combined',
-            params={'filter[minister_id]': minister['id']})['results']
+        recent_questions = loaded['recent_questions']['results']
 
     # meetings
-    all_meetings = load_from_api(
-        links['meetings'],
-        fields=['id', 'title', 'date'],
-        return_everything=True)['results']
+    all_meetings = loaded['meetings']['results']
 
     for meeting in all_meetings:
         d = meeting['parsed_date'] = datetime.strptime(meeting['date'][:10],
@@ -379,18 +429,10 @@ def committee_detail(committee_id):
     else:
         attendance_rank = None
 
-    bills = load_from_api(
-        'v2/committees/%s/bills' % committee_id,
-        fields=['id', 'title', 'status', 'date_of_introduction', 'code'],
-    )['results']
-
+    bills = loaded['bills']['results']
     bills.sort(key=lambda b: b['date_of_introduction'], reverse=True)
 
-    # If the request came from a Provincial Committee page,
-    # pass the slug to the template to build the correct breadcrumbs
-    from_page = request.args.get('from_page')
-    return render_template(
-        'committee_detail.html',
+    return dict(
         current_year=now.year,
         earliest_year=earliest_year,
         filtered_meetings=filtered_meetings,
@@ -403,9 +445,7 @@ def committee_detail(committee_id):
         current_attendance_summary=current_attendance_summary,
         historical_attendance_summary=historical_attendance_summary,
         attendance_rank=attendance_rank,
-        admin_edit_url=admin_url('committee', committee_id),
-        bills=bills,
-        from_page=from_page)
+        bills=bills)
 
 
 @app.route('/committee/<int:committee_id>/follow-cte')
@@ -520,6 +560,10 @@ def committee_question(question_id):
 
 
 @app.route('/committees/')
+@cache.memoize(
+    timeout=LONG_CACHE_TIMEOUT,
+    make_name=lambda fname: cache_key(request, tags=['model:Committee']),
+    unless=lambda: should_skip_cache(request, current_user))
 def committees():
     """
     Page through all available committees.
@@ -651,8 +695,10 @@ def committee_meetings(page=0):
 
 @app.route('/committee-meeting/<int:event_id>')
 @app.route('/committee-meeting/<int:event_id>/')
+@conditional(lambda event_id: CommitteeMeeting.query.filter(CommitteeMeeting.id == event_id))
 @cache.memoize(
-    make_name=lambda fname: cache_key(request),
+    timeout=LONG_CACHE_TIMEOUT,
+    make_name=lambda fname: cache_key(request, tags=['Event:{event_id}', 'model:Committee', 'model:Member']),
     unless=lambda: should_skip_cache(request, current_user))
 def committee_meeting(event_id):
     """
@@ -668,17 +714,8 @@ def committee_meeting(event_id):
         premium_committees = None
 
     audio, related_docs = classify_attachments(event.get('files', []))
+    attendance = committee_meeting_attendance(event_id)
 
-    attendance = load_from_api(
-        'v2/committee-meetings/%s/attendance' % event_id,
-        return_everything=True)['results']
-    attendance = [
-        a for a in attendance if a['attendance'] in CommitteeMeetingAttendance.
-        ATTENDANCE_CODES_PRESENT
-    ]
-    sorter = lambda x: x['member']['name']
-    attendance = sorted([a for a in attendance if a['chairperson']], key=sorter) + \
-                 sorted([a for a in attendance if not a['chairperson']], key=sorter)  # noqa
     if event['chairperson']:
         social_summary = "A meeting of the " + event['committee'][
             'name'] + " committee held on " + pretty_date(
@@ -702,6 +739,26 @@ def committee_meeting(event_id):
         SOUNDCLOUD_APP_KEY_ID=app.config['SOUNDCLOUD_APP_KEY_ID']),
 
 
+@cache.memoize(
+    timeout=LONG_CACHE_TIMEOUT,
+    make_name=lambda fname: cache_key(request, tags=['Event:{event_id}', 'model:Member']))
+def committee_meeting_attendance(event_id):
+    """
+    Members who attended a meeting, chairpeople first. This is the same for all
+    users, so it's cached for logged in users too, unlike the meeting page.
+    """
+    attendance = load_from_api(
+        'v2/committee-meetings/%s/attendance' % event_id,
+        return_everything=True)['results']
+    attendance = [
+        a for a in attendance if a['attendance'] in CommitteeMeetingAttendance.
+        ATTENDANCE_CODES_PRESENT
+    ]
+    sorter = lambda x: x['member']['name']
+    return sorted([a for a in attendance if a['chairperson']], key=sorter) + \
+        sorted([a for a in attendance if not a['chairperson']], key=sorter)  # noqa
+
+
 @app.route('/committee-meeting/<int:event_id>/follow-cte')
 @app.route('/committee-meeting/<int:event_id>/follow-cte/')
 def committee_meeting_follow_cte(event_id):
@@ -1081,17 +1138,36 @@ def provincial_legislatures_detail(slug):
     if slug == 'western-cape':
         return provincial_legislatures_western_cape(slug, province)
 
-    # Provincial programmes are stored as daily schedules
-    # We only show the latest
-    provincial_programmes = load_from_api(
-        'v2/daily-schedules',
-        return_everything=True,
-        params={'filter[house]': province.name_short})['results']
+    loads = {
+        # Provincial programmes are stored as daily schedules
+        'programmes': {
+            'resource_name': 'v2/daily-schedules',
+            'return_everything': True,
+            'params': {'filter[house]': province.name_short},
+        },
+        'committees': {
+            'resource_name': 'v2/committees',
+            'return_everything': True,
+        },
+        'members': {
+            'resource_name': 'v2/members',
+            'return_everything': True,
+            'params': {'filter[house]': province.name_short},
+        },
+    }
+    if province.speaker_id:
+        loads['speaker'] = {
+            'resource_name': 'v2/members',
+            'resource_id': province.speaker_id,
+        }
+    loaded = load_many_from_api(loads)
+
+    # We only show the latest programme
+    provincial_programmes = loaded['programmes']['results']
     latest_programme = provincial_programmes[
         0] if provincial_programmes else None
 
-    committees = load_from_api(
-        'v2/committees', return_everything=True)['results']
+    committees = loaded['committees']['results']
     provincial_committees = [
         c for c in committees
         if c['house']['short_name'] == province.name_short
@@ -1100,10 +1176,7 @@ def provincial_legislatures_detail(slug):
     provincial_committees.sort(key=lambda c: [-c['monitored'], c['name']])
 
     # Members
-    members = load_from_api(
-        'v2/members',
-        return_everything=True,
-        params={'filter[house]': province.name_short})['results']
+    members = loaded['members']['results']
     mpls = []
     for member in members:
         if member.get('house') and member['current'] and member['house'][
@@ -1111,7 +1184,7 @@ def provincial_legislatures_detail(slug):
             mpls.append(member)
 
     if province.speaker_id:
-        speaker = load_from_api('v2/members', province.speaker_id)['result']
+        speaker = loaded['speaker']['result']
     else:
         speaker = None
 
@@ -1132,7 +1205,35 @@ def provincial_legislatures_detail(slug):
 
 
 def provincial_legislatures_western_cape(slug, province):
-    members = load_from_api('v2/members', return_everything=True)['results']
+    loads = {
+        'members': {
+            'resource_name': 'v2/members',
+            'return_everything': True,
+        },
+        'committees': {
+            'resource_name': 'v2/committees',
+            'return_everything': True,
+        },
+        'calls_for_comment': {
+            'resource_name': 'v2/calls-for-comments',
+            'return_everything': True,
+            'fields': ['id', 'title', 'closed', 'end_date', 'start_date'],
+            'params': {'filter[house]': 'WC'},
+        },
+        'programmes': {
+            'resource_name': 'v2/daily-schedules',
+            'return_everything': True,
+            'params': {'filter[house]': 'WC'},
+        },
+    }
+    if province.speaker_id:
+        loads['speaker'] = {
+            'resource_name': 'v2/members',
+            'resource_id': province.speaker_id,
+        }
+    loaded = load_many_from_api(loads)
+
+    members = loaded['members']['results']
 
     # members of provincial parliament
     mpls = []
@@ -1142,13 +1243,12 @@ def provincial_legislatures_western_cape(slug, province):
             mpls.append(member)
 
     if province.speaker_id:
-        speaker = load_from_api('v2/members', province.speaker_id)['result']
+        speaker = loaded['speaker']['result']
     else:
         speaker = None
 
     # provincial committees
-    committees = load_from_api(
-        'v2/committees', return_everything=True)['results']
+    committees = loaded['committees']['results']
     # Only show monitored committees:
     committees[:] = [c for c in committees if c['monitored'] == True]
 
@@ -1159,20 +1259,12 @@ def provincial_legislatures_western_cape(slug, province):
             provincial_committees.append(committee)
 
     # provincial calls for comments that are currently open
-    provincial_calls_for_comment = load_from_api(
-        'v2/calls-for-comments',
-        return_everything=True,
-        fields=['id', 'title', 'closed', 'end_date', 'start_date'],
-        params={'filter[house]': 'WC'})['results']
     provincial_calls_for_comment = [
-        c for c in provincial_calls_for_comment
+        c for c in loaded['calls_for_comment']['results']
         if c['end_date'] and not c['closed']
     ]
 
-    provincial_programmes = load_from_api(
-        'v2/daily-schedules',
-        return_everything=True,
-        params={'filter[house]': 'WC'})['results']
+    provincial_programmes = loaded['programmes']['results']
     latest_programme = provincial_programmes[
         0] if provincial_programmes else None
 
@@ -1441,7 +1533,8 @@ def question_replies(page=0):
 @app.route('/search/')
 @app.route('/search/<int:page>/')
 @cache.memoize(
-    make_name=lambda fname: cache_key(request),
+    timeout=LONG_CACHE_TIMEOUT,
+    make_name=lambda fname: cache_key(request, tags=['search']),
     unless=lambda: should_skip_cache(request, current_user))
 def search(page=0):
     """
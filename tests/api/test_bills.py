@@ -1,4 +1,7 @@
+from mock import patch
+
 from tests import PMGTestCase
+from pmg import app
 from tests.fixtures import dbfixture, BillData, BillTypeData
 
 
@@ -24,3 +27,13 @@ class TestBillAPI(PMGTestCase):
             'bill/pmb/', base_url='http://api.pmg.test:5000/')
         self.assertEqual(200, res.status_code)
         self.assertEqual(2, res.json['count'])
+
+    def test_count_without_cache(self):
+        """
+        Lists are still counted if the cache backend fails
+        """
+        with patch.object(app, 'debug', False), patch('pmg.api.counts.cache') as cache:
+            cache.get.side_effect = cache.set.side_effect = Exception('cache is down')
+            res = self.client.get('bill/', base_url='http://api.pmg.test:5000/')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(5, res.json['count'])
@@ -0,0 +1,80 @@
+from mock import patch
+from werkzeug.exceptions import NotFound
+
+from tests import PMGTestCase
+from tests.fixtures import dbfixture, HouseData, CommitteeData, CommitteeMeetingData
+from pmg import app
+from pmg.api.client import load_from_api, load_many_from_api, load_remaining_pages
+
+
+@patch('pmg.api.client.API_IN_PROCESS', True)
+class TestInProcessApiClient(PMGTestCase):
+    def setUp(self):
+        super(TestInProcessApiClient, self).setUp()
+        self.fx = dbfixture.data(HouseData, CommitteeData, CommitteeMeetingData)
+        self.fx.setup()
+
+    def tearDown(self):
+        self.fx.teardown()
+        super(TestInProcessApiClient, self).tearDown()
+
+    def test_same_as_http(self):
+        committee = self.fx.CommitteeData.arts
+        expected = self.client.get(
+            "/v2/committees/%s" % committee.id,
+            base_url="http://api.pmg.test:5000/",
+        ).json
+
+        with app.test_request_context('/', base_url="http://pmg.test:5000/"):
+            result = load_from_api('v2/committees', committee.id)
+
+        self.assertEqual(expected, result)
+
+    def test_v1_dates_as_strings(self):
+        meeting = self.fx.CommitteeMeetingData.arts_meeting_one
+        with app.test_request_context('/', base_url="http://pmg.test:5000/"):
+            result = load_from_api('committee-meeting', meeting.id)
+
+        self.assertEqual(meeting.title, result['title'])
+        self.assertTrue(result['date'].startswith('2019-01-01'))
+
+    def test_return_everything(self):
+        with app.test_request_context('/', base_url="http://pmg.test:5000/"):
+            result = load_from_api('v2/committees', return_everything=True, pagesize=1)
+
+        self.assertEqual(3, result['count'])
+        self.assertEqual(3, len(result['results']))
+        self.assertNotIn('next', result)
+
+    def test_return_everything_with_low_estimate(self):
+        pages = {1: [2], 2: [3], 3: []}
+        first = {'count': 2, 'results': [1]}
+        with patch('pmg.api.client.load_page', side_effect=lambda url, headers, params, page: pages[page]):
+            with app.test_request_context('/', base_url="http://pmg.test:5000/"):
+                results = load_remaining_pages('http://api.pmg.test:5000/v2/committees/', {}, {}, first)
+
+        self.assertEqual([2, 3], results)
+
+    def test_not_found(self):
+        with app.test_request_context('/', base_url="http://pmg.test:5000/"):
+            with self.assertRaises(NotFound):
+                load_from_api('v2/committees', 9999)
+
+    def test_load_many(self):
+        committee = self.fx.CommitteeData.arts
+        with app.test_request_context('/', base_url="http://pmg.test:5000/"):
+            result = load_many_from_api({
+                'committee': {'resource_name': 'v2/committees', 'resource_id': committee.id},
+                'meetings': {'resource_name': 'v2/committees/%s/meetings' % committee.id, 'return_everything': True},
+            })
+
+        self.assertEqual(committee.name, result['committee']['result']['name'])
+        self.assertEqual(2, len(result['meetings']['results']))
+
+    def test_load_many_error(self):
+        with app.test_request_context('/', base_url="http://pmg.test:5000/"):
+            with self.assertRaises(NotFound):
+                load_many_from_api({
+                    'committees': {'resource_name': 'v2/committees'},
+                    'missing': {'resource_name': 'v2/committees', 'resource_id': 9999},
+                })
@@ -1,5 +1,12 @@
+import json
+from mock import patch
+
+from werkzeug.contrib.cache import SimpleCache
+
 from tests import PMGTestCase
-from tests.fixtures import dbfixture, HouseData, CommitteeData, CommitteeMeetingData
+from pmg.caching import TieredCache
+from pmg.models import db, Bill, CommitteeMeeting
+from tests.fixtures import dbfixture, HouseData, CommitteeData, CommitteeMeetingData, BillData
 
 
 class TestCommitteeMeetingsAPI(PMGTestCase):
@@ -28,3 +35,129 @@ class TestCommitteeMeetingsAPI(PMGTestCase):
         )
         self.assertEqual(200, res.status_code)
         self.assertIsNone(res.json.get("premium_content_excluded"))
+
+    def test_cursor_pagination(self):
+        url = "http://api.pmg.test:5000/v2/committee-meetings/?cursor=&per_page=1&fields=id,date"
+        dates = []
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(200, res.status_code)
+            self.assertIsNone(res.json["count"])
+            self.assertEqual(1, len(res.json["results"]))
+            dates.append(res.json["results"][0]["date"])
+            url = res.json["next"]
+
+        self.assertEqual(4, len(dates))
+        self.assertEqual(sorted(dates, reverse=True), dates)
+
+    def test_cursor_pagination_count(self):
+        res = self.client.get(
+            "/committee-meeting/?cursor=&count=true",
+            base_url="http://api.pmg.test:5000/",
+        )
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(4, res.json["count"])
+        self.assertIsNone(res.json["next"])
+
+    def test_invalid_cursor(self):
+        res = self.client.get(
+            "/committee-meeting/?cursor=nonsense",
+            base_url="http://api.pmg.test:5000/",
+        )
+        self.assertEqual(422, res.status_code)
+
+    def test_field_selection(self):
+        for fields in ["id", "id,title", "id"]:
+            res = self.client.get(
+                "/v2/committee-meetings/?fields=%s" % fields,
+                base_url="http://api.pmg.test:5000/",
+            )
+            self.assertEqual(200, res.status_code)
+            self.assertEqual(set(fields.split(",")), set(res.json["results"][0].keys()))
+
+    def test_field_selection_premium(self):
+        committee = self.fx.CommitteeData.communications
+        res = self.client.get(
+            "/v2/committees/%s/meetings?fields=id,premium_content_excluded" % committee.id,
+            base_url="http://api.pmg.test:5000/",
+        )
+        self.assertEqual(200, res.status_code)
+        excluded = dict((r["id"], r["premium_content_excluded"]) for r in res.json["results"])
+        self.assertTrue(excluded[self.fx.CommitteeMeetingData.premium_recent.id])
+        self.assertFalse(excluded[self.fx.CommitteeMeetingData.premium_old.id])
+
+    def test_export(self):
+        res = self.client.get(
+            "/v2/committee-meetings/export?fields=id,premium_content_excluded",
+            base_url="http://api.pmg.test:5000/",
+        )
+        self.assertEqual(200, res.status_code)
+        self.assertEqual("application/x-ndjson", res.mimetype)
+
+        items = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual(4, len(items))
+        premium = [i for i in items if i["id"] == self.fx.CommitteeMeetingData.premium_recent.id][0]
+        self.assertTrue(premium["premium_content_excluded"])
+
+    @patch('pmg.api.v2.EXPORT_BATCH_SIZE', 3)
+    def test_export_in_batches(self):
+        res = self.client.get(
+            "/v2/committee-meetings/export",
+            base_url="http://api.pmg.test:5000/",
+        )
+        self.assertEqual(200, res.status_code)
+
+        items = [json.loads(line) for line in res.data.splitlines()]
+        ids = [i["id"] for i in items]
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(4, len(set(ids)))
+        self.assertIn("committee", items[0])
+
+    def test_export_unknown_resource(self):
+        res = self.client.get(
+            "/v2/nonsense/export",
+            base_url="http://api.pmg.test:5000/",
+        )
+        self.assertEqual(404, res.status_code)
+
+    @patch('pmg.cache', TieredCache(SimpleCache()))
+    @patch('pmg.api.conditional.cache', TieredCache(SimpleCache()))
+    def test_conditional_request(self):
+        url = "http://api.pmg.test:5000/v2/committee-meetings/?fields=id,title"
+        res = self.client.get(url)
+        self.assertEqual(200, res.status_code)
+        etag = res.headers["ETag"]
+        self.assertIsNotNone(res.last_modified)
+
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(304, res.status_code)
+        self.assertEqual("", res.data)
+
+        meeting = CommitteeMeeting.query.get(self.fx.CommitteeMeetingData.premium_old.id)
+        meeting.title = "A new title"
+        db.session.commit()
+
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(200, res.status_code)
+        self.assertNotEqual(etag, res.headers["ETag"])
+
+    @patch('pmg.cache', TieredCache(SimpleCache()))
+    @patch('pmg.api.conditional.cache', TieredCache(SimpleCache()))
+    def test_conditional_request_association_changed(self):
+        fx = dbfixture.data(BillData)
+        fx.setup()
+        url = "http://api.pmg.test:5000/v2/committee-meetings/?fields=id,title"
+        etag = self.client.get(url).headers["ETag"]
+
+        # only adds a row to the event_bills association table
+        meeting = CommitteeMeeting.query.get(self.fx.CommitteeMeetingData.premium_old.id)
+        meeting.bills.append(Bill.query.get(fx.BillData.food.id))
+        db.session.commit()
+
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(200, res.status_code)
+        self.assertNotEqual(etag, res.headers["ETag"])
+
+        meeting.bills = []
+        db.session.commit()
+        fx.teardown()
@@ -0,0 +1,27 @@
+import datetime
+
+from mock import patch
+
+from tests import PMGTestCase
+from pmg.models import db, PolicyDocument
+
+
+class TestPolicyDocumentsAPI(PMGTestCase):
+    def setUp(self):
+        super(TestPolicyDocumentsAPI, self).setUp()
+        for i, start_date in enumerate([datetime.date(2019, 1, 1), None, datetime.date(2019, 2, 1), None]):
+            db.session.add(PolicyDocument(title='Policy %d' % i, start_date=start_date))
+        db.session.commit()
+
+    @patch.object(PolicyDocument, 'cursor_columns', ('start_date', 'id'))
+    def test_cursor_pagination_with_nulls(self):
+        url = "http://api.pmg.test:5000/policy-document/?cursor=&per_page=1"
+        dates = []
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(200, res.status_code)
+            dates.append(res.json["results"][0]["start_date"])
+            url = res.json["next"]
+
+        self.assertEqual(4, len(dates))
+        self.assertEqual(["2019-02-01", "2019-01-01", None, None], [d and d[:10] for d in dates])
@@ -1,5 +1,9 @@
+from mock import patch
+from werkzeug.contrib.cache import SimpleCache
+
 from tests import PMGTestCase
-from pmg.models import db, CommitteeMeeting, CommitteeMeetingAttendance, Committee, House, Province, Party, Member
+from pmg.caching import TieredCache, invalidate_tags
+from pmg.models import db, CommitteeMeeting, CommitteeMeetingAttendance, Committee, House, Province, Party, Member, MemberAttendanceStats
 
 
 class TestCommitteeMeetingAttendance(PMGTestCase):
@@ -108,3 +112,56 @@ class TestCommitteeMeetingAttendance(PMGTestCase):
                           (1, 'P', 2019.0, 1, 1L),
                           (2, 'A', 2019.0, 1, 1L),
                           (2, 'P', 2019.0, 1, 1L)], historical_attendance)
+
+    def test_attendance_stats_updated(self):
+        """
+        the attendance stats are kept up to date as attendance and meetings change
+        """
+        committee = Committee.query.filter_by(name='Arts and Culture').first()
+        attendance = CommitteeMeetingAttendance.query\
+            .join(CommitteeMeeting)\
+            .filter(CommitteeMeeting.title == 'Arts 2', CommitteeMeetingAttendance.attendance == 'A')\
+            .one()
+        attendance.attendance = 'P'
+        db.session.commit()
+
+        self.assertEqual([(1, 'P', 2019, 1, 1), (2, 'P', 2019, 1, 1)], CommitteeMeetingAttendance.summary())
+        self.assertEqual(
+            [(2019, 1, 1.0, 2.0)],
+            CommitteeMeetingAttendance.committee_attendence_trends(committee.id, 'current'))
+
+        meeting = CommitteeMeeting.query.filter_by(title='Arts 2').one()
+        meeting.date = '2020-08-01'
+        db.session.commit()
+
+        self.assertEqual([(1, 'P', 2020, 1, 1), (2, 'P', 2020, 1, 1)], CommitteeMeetingAttendance.summary())
+
+        db.session.delete(meeting)
+        db.session.commit()
+
+        self.assertEqual([], CommitteeMeetingAttendance.summary())
+        self.assertEqual([], CommitteeMeetingAttendance.committee_attendence_trends(committee.id, 'current'))
+
+    def test_annual_attendance_rank_for_committee(self):
+        committee = Committee.query.filter_by(name='Arts and Culture').first()
+        self.assertEqual((1, 1), CommitteeMeetingAttendance.annual_attendance_rank_for_committee(committee, 2019))
+        self.assertEqual((None, 0), CommitteeMeetingAttendance.annual_attendance_rank_for_committee(committee, 2018))
+
+    def test_annual_attendance_ranks_cached(self):
+        cache = TieredCache(SimpleCache())
+        trends = CommitteeMeetingAttendance.annual_attendance_trends
+        with patch('pmg.cache', cache), patch('pmg.models.resources.cache', cache), \
+                patch.object(CommitteeMeetingAttendance, 'annual_attendance_trends', wraps=trends) as compute:
+            ranks = CommitteeMeetingAttendance.annual_attendance_ranks()
+            self.assertEqual(ranks, CommitteeMeetingAttendance.annual_attendance_ranks())
+            self.assertEqual(1, compute.call_count)
+
+            invalidate_tags(['model:CommitteeMeetingAttendance'])
+            CommitteeMeetingAttendance.annual_attendance_ranks()
+            self.assertEqual(2, compute.call_count)
+
+    def test_member_attendance_pivot(self):
+        rows = MemberAttendanceStats.pivot('historical').all()
+        self.assertEqual([(2019, 1), (2019, 2)], [(r.year, r.member_id) for r in rows])
+        self.assertEqual([(1, 1), (1, 1)], [(r.A, r.P) for r in rows])
+        self.assertEqual([0, 0], [r.AP for r in rows])
@@ -0,0 +1,230 @@
+import datetime
+import shutil
+import tempfile
+from time import time
+
+import gevent
+from flask import Flask, request
+from mock import patch, MagicMock
+from nose.tools import *  # noqa
+from unittest import TestCase
+from werkzeug.contrib.cache import SimpleCache, FileSystemCache, RedisCache
+
+from tests import PMGTestCase
+from pmg import app, canonical_url
+from pmg.caching import Cache, TieredCache, LRUCache, tag_versions, invalidate_tags, warm, FOREVER
+from pmg.models import db, House, Committee, CommitteeMeeting
+from pmg.models.resources import cache_tags
+
+
+class TestLRUCache(TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_bytes=10)
+        lru.set('a', 'aaaa', 60)
+        lru.set('b', 'bbbb', 60)
+        lru.get('a')
+        lru.set('c', 'cccc', 60)
+
+        assert_equal('aaaa', lru.get('a'))
+        assert_is_none(lru.get('b'))
+        assert_equal('cccc', lru.get('c'))
+        assert_equal(8, lru.bytes)
+        assert_equal(1, lru.evictions)
+
+    def test_expiry(self):
+        lru = LRUCache(max_bytes=10)
+        lru.set('a', 'aaaa', -1)
+        assert_is_none(lru.get('a'))
+        assert_equal(0, lru.bytes)
+
+
+class TestTieredCache(TestCase):
+    def setUp(self):
+        # stands in for redis, shared by both processes
+        self.shared = SimpleCache()
+        self.cache = TieredCache(self.shared, local_max_bytes=1024, max_item_bytes=512)
+        self.other = TieredCache(self.shared, local_max_bytes=1024, max_item_bytes=512)
+
+    def test_shared_between_processes(self):
+        self.cache.set('key', {'a': [1, 2]})
+
+        assert_equal({'a': [1, 2]}, self.other.get('key'))
+        assert_equal({'a': [1, 2]}, self.other.get('key'))
+        assert_equal(1, self.other.counts['shared_hits'])
+        assert_equal(1, self.other.counts['local_hits'])
+
+    def test_returns_copies(self):
+        self.cache.set('key', {'a': [1, 2]})
+        self.cache.get('key')['a'].append(3)
+        assert_equal({'a': [1, 2]}, self.cache.get('key'))
+
+    def test_miss(self):
+        assert_is_none(self.cache.get('missing'))
+        assert_equal(1, self.cache.counts['misses'])
+
+    def test_too_large(self):
+        self.cache.set('key', 'small')
+        assert_false(self.cache.set('key', 'x' * 1024))
+        assert_is_none(self.cache.get('key'))
+        assert_is_none(self.other.get('key'))
+
+    def test_tag_versions_not_kept_locally(self):
+        self.cache.set('tag-version:Committee:1', 'v1')
+        self.other.get('tag-version:Committee:1')
+        self.cache.set('tag-version:Committee:1', 'v2')
+        assert_equal('v2', self.other.get('tag-version:Committee:1'))
+
+    def test_never_expires(self):
+        self.cache.set('key', 'value', timeout=0)
+        with patch('werkzeug.contrib.cache.time', return_value=time() + 60):
+            assert_equal('value', self.other.get('key'))
+
+    def test_delete(self):
+        self.cache.set('key', 'value')
+        self.cache.delete('key')
+        assert_is_none(self.cache.get('key'))
+        assert_is_none(self.other.get('key'))
+
+
+class TestCacheTags(PMGTestCase):
+    def check_invalidate_tags(self, shared):
+        with patch('pmg.cache', TieredCache(shared)):
+            versions = tag_versions(['a', 'b'])
+            # versions outlive the backend's expiry checks
+            with patch('werkzeug.contrib.cache.time', return_value=time() + 60):
+                assert_equal(versions, tag_versions(['a', 'b']))
+
+                invalidate_tags(['b'])
+            with patch('werkzeug.contrib.cache.time', return_value=time() + 120):
+                new_versions = tag_versions(['a', 'b'])
+
+        assert_equal(versions[0], new_versions[0])
+        assert_not_equal(versions[1], new_versions[1])
+
+    def test_invalidate_tags_simple(self):
+        self.check_invalidate_tags(SimpleCache())
+
+    def test_invalidate_tags_filesystem(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self.check_invalidate_tags(FileSystemCache(cache_dir))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_invalidate_tags_redis(self):
+        client = MagicMock()
+        client.mget.return_value = [None, None]
+        with patch('pmg.cache', TieredCache(RedisCache(client))):
+            tag_versions(['a', 'b'])
+            invalidate_tags(['b'])
+
+        # redis rejects a timeout of 0
+        timeouts = [c[1]['time'] for c in client.setex.call_args_list]
+        assert_equal([FOREVER] * 3, timeouts)
+
+    def test_cache_tags(self):
+        house = House(name='National Assembly', sphere='national', name_short='na')
+        committee = Committee(name='Arts', house=house)
+        meeting = CommitteeMeeting(title='Meeting', date='2019-01-01', committee=committee)
+        db.session.add(meeting)
+        db.session.commit()
+
+        tags = cache_tags(meeting)
+        assert_in('model:CommitteeMeeting', tags)
+        assert_in('model:Event', tags)
+        assert_in('Event:%s' % meeting.id, tags)
+        assert_in('Committee:%s' % committee.id, tags)
+        assert_in('model:CommitteeMeetingAttendanceStats', tags)
+
+
+    def test_invalidates_previous_references(self):
+        house = House(name='National Assembly', sphere='national', name_short='na')
+        arts = Committee(name='Arts', house=house)
+        sport = Committee(name='Sport', house=house)
+        meeting = CommitteeMeeting(title='Meeting', date='2019-01-01', committee=arts)
+        db.session.add_all([meeting, sport])
+        db.session.commit()
+
+        with patch('pmg.models.resources.invalidate_tags') as invalidate:
+            meeting.committee = sport
+            db.session.commit()
+
+        tags = set(tag for args, kwargs in invalidate.call_args_list for tag in args[0])
+        assert_in('Committee:%s' % arts.id, tags)
+        assert_in('Committee:%s' % sport.id, tags)
+
+
+    def test_committee_detail_cache_key_changes_daily(self):
+        from pmg.views import committee_detail_cache_key
+
+        with patch('pmg.cache', TieredCache(SimpleCache())), patch('pmg.views.date') as date, \
+                app.test_request_context('/committee/1/', base_url='http://pmg.test:5000/'):
+            date.today.return_value = datetime.date(2019, 12, 31)
+            key = committee_detail_cache_key('committee_detail')
+            assert_equal(key, committee_detail_cache_key('committee_detail'))
+
+            date.today.return_value = datetime.date(2020, 1, 1)
+            assert_not_equal(key, committee_detail_cache_key('committee_detail'))
+
+
+class TestCanonicalUrl(TestCase):
+    def canonical(self, url, base_url='http://api.pmg.test:5000/'):
+        with app.test_request_context(url, base_url=base_url):
+            return canonical_url(request)
+
+    def test_sorts_params(self):
+        assert_equal(self.canonical('/bill/?b=2&a=1'), self.canonical('/bill/?a=1&b=2'))
+
+    def test_drops_ignored_params(self):
+        assert_equal('api.pmg.test:5000/bill?a=1', self.canonical('/bill/?a=1&via=twitter&utm_source=x'))
+
+    def test_host(self):
+        assert_equal(self.canonical('/bill/'), self.canonical('/bill', base_url='http://API.pmg.test:5000/'))
+
+    def test_host_aliases(self):
+        with patch.dict(app.config['CACHE_KEY_HOST_ALIASES'], {'www.pmg.test:5000': 'pmg.test:5000'}):
+            assert_equal('pmg.test:5000/', self.canonical('/', base_url='http://www.pmg.test:5000/'))
+
+
+class TestMemoize(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['CACHE_STALE_TIMEOUT'] = 60
+        self.cache = Cache(self.app, config={'CACHE_TYPE': 'simple'})
+        self.calls = []
+
+    def test_serves_stale_while_refreshing(self):
+        @self.cache.memoize(timeout=10)
+        def count():
+            self.calls.append(1)
+            return len(self.calls)
+
+        assert_equal(1, count())
+        with patch('pmg.caching.time', return_value=time() + 20):
+            # stale, but returned immediately
+            assert_equal(1, count())
+            # let the refresh run
+            gevent.sleep(0)
+        assert_equal(2, count())
+        assert_equal(2, len(self.calls))
+
+    def test_coalesces_misses(self):
+        @self.cache.memoize()
+        def slow():
+            self.calls.append(1)
+            gevent.sleep(0.01)
+            return 'value'
+
+        greenlets = [gevent.spawn(slow) for i in range(5)]
+        gevent.joinall(greenlets)
+
+        assert_equal(['value'] * 5, [g.value for g in greenlets])
+        assert_equal(1, len(self.calls))
+
+
+class TestWarm(PMGTestCase):
+    def test_warm(self):
+        results = warm(['/bills/explained/', '/nonsense/'], concurrency=2)
+
+        assert_equal(['/bills/explained/', '/nonsense/'], [url for url, status, elapsed in results])
+        assert_equal([200, 404], [status for url, status, elapsed in results])
@@ -1,18 +1,23 @@
+from datetime import datetime, timedelta
+import hashlib
+import tempfile
+
 from mock import patch
 from nose.tools import *  # noqa
 import arrow
+import pytz
 
 from tests import PMGTestCase
 from pmg import app
-from pmg.models import db, CommitteeMeeting
-from pmg.search import Search
+from pmg.models import db, CommitteeMeeting, SearchSync, SearchQueue, File, FileText
+from pmg.search import Search, clean_item
 from pyelasticsearch import ElasticSearch
 
 
 class TestSearch(PMGTestCase):
     @patch.object(ElasticSearch, 'bulk_index')
-    @patch.multiple(Search, reindex_changes=True)
-    def test_new_object_reindexed(self, bulk_index):
+    @patch.multiple(Search, reindex_changes=True, queue_changes=True)
+    def test_new_object_queued(self, bulk_index):
         with app.app_context():
             cm = CommitteeMeeting()
             cm.date = arrow.now().datetime
@@ -20,10 +25,30 @@ class TestSearch(PMGTestCase):
             db.session.add(cm)
             db.session.commit()
 
+            assert_false(bulk_index.called)
+            assert_equal([('committee-meeting', cm.id)],
+                         [(q.slug_prefix, q.model_id) for q in SearchQueue.query.all()])
+
+            Search().index_queued()
             assert_true(bulk_index.called)
+            assert_equal(0, SearchQueue.query.count())
+
+    @patch.multiple(Search, reindex_changes=True, queue_changes=True)
+    def test_queued_with_changes(self):
+        with app.app_context():
+            cm = CommitteeMeeting()
+            cm.date = arrow.now().datetime
+            cm.title = "Foo"
+            db.session.add(cm)
+            db.session.flush()
+            assert_equal(1, SearchQueue.query.count())
+
+            # rolled back along with the change
+            db.session.rollback()
+            assert_equal(0, SearchQueue.query.count())
 
     @patch.object(ElasticSearch, 'bulk_index')
-    @patch.multiple(Search, reindex_changes=True)
+    @patch.multiple(Search, reindex_changes=True, queue_changes=True)
     def test_updated_object_reindexed(self, bulk_index):
         with app.app_context():
             cm = CommitteeMeeting()
@@ -32,17 +57,24 @@ class TestSearch(PMGTestCase):
             db.session.add(cm)
             db.session.commit()
 
+            Search().index_queued()
             assert_true(bulk_index.called)
             bulk_index.reset_mock()
 
-            # now update it
+            # now update it, twice
             cm.title = "Updated"
             db.session.commit()
-            assert_true(bulk_index.called)
+            cm.title = "Updated again"
+            db.session.commit()
+
+            Search().index_queued()
+            # indexed once
+            assert_equal(1, bulk_index.call_count)
+            assert_equal(1, len(bulk_index.call_args[0][2]))
 
     @patch.object(ElasticSearch, 'bulk_index')
     @patch.object(ElasticSearch, 'delete')
-    @patch.multiple(Search, reindex_changes=True)
+    @patch.multiple(Search, reindex_changes=True, queue_changes=True)
     def test_deleted_object_reindexed(self, delete, bulk_index):
         with app.app_context():
             cm = CommitteeMeeting()
@@ -51,11 +83,188 @@ class TestSearch(PMGTestCase):
             db.session.add(cm)
             db.session.commit()
 
+            Search().index_queued()
             assert_true(bulk_index.called)
             bulk_index.reset_mock()
 
             # now delete it
+            cm_id = cm.id
             db.session.delete(cm)
             db.session.commit()
+            Search().index_queued()
             assert_false(bulk_index.called)
-            assert_true(delete.called)
+            delete.assert_called_once_with('pmg', 'committee_meeting', cm_id)
+
+    @patch.object(ElasticSearch, 'bulk_index')
+    @patch.multiple(Search, reindex_changes=True, queue_changes=False)
+    def test_new_object_reindexed_without_queue(self, bulk_index):
+        with app.app_context():
+            cm = CommitteeMeeting()
+            cm.date = arrow.now().datetime
+            cm.title = "Foo"
+            db.session.add(cm)
+            db.session.commit()
+
+            assert_true(bulk_index.called)
+            assert_equal(0, SearchQueue.query.count())
+
+    @patch.object(ElasticSearch, 'bulk_index')
+    @patch.multiple(Search, reindex_changes=True, queue_changes=True)
+    def test_queue_kept_when_indexing_fails(self, bulk_index):
+        with app.app_context():
+            cm = CommitteeMeeting()
+            cm.date = arrow.now().datetime
+            cm.title = "Foo"
+            db.session.add(cm)
+            db.session.commit()
+
+            bulk_index.side_effect = IOError("ElasticSearch is down")
+            assert_raises(IOError, Search().index_queued)
+            assert_equal(1, SearchQueue.query.count())
+
+    @patch.object(ElasticSearch, 'delete_index')
+    @patch.object(ElasticSearch, 'update_aliases')
+    @patch.object(ElasticSearch, 'get_aliases')
+    def test_swap_index(self, get_aliases, update_aliases, delete_index):
+        get_aliases.return_value = {'pmg-20190101000000': {'aliases': {'pmg': {}}}}
+        Search().swap_index('pmg-20190201000000')
+
+        update_aliases.assert_called_once_with([
+            {'add': {'index': 'pmg-20190201000000', 'alias': 'pmg'}},
+            {'remove': {'index': 'pmg-20190101000000', 'alias': 'pmg'}},
+        ])
+        delete_index.assert_called_once_with('pmg-20190101000000')
+
+    @patch.object(ElasticSearch, 'delete_index')
+    @patch.object(ElasticSearch, 'update_aliases')
+    @patch.object(ElasticSearch, 'get_aliases')
+    def test_swap_unversioned_index(self, get_aliases, update_aliases, delete_index):
+        get_aliases.return_value = {'pmg': {'aliases': {}}}
+        Search().swap_index('pmg-20190201000000')
+
+        delete_index.assert_called_once_with('pmg')
+        update_aliases.assert_called_once_with([
+            {'add': {'index': 'pmg-20190201000000', 'alias': 'pmg'}},
+        ])
+
+    @patch.object(ElasticSearch, 'bulk_index')
+    @patch.multiple(Search, per_batch=2, serialise_processes=1)
+    def test_reindex_for_model(self, bulk_index):
+        with app.app_context():
+            for i in range(5):
+                cm = CommitteeMeeting()
+                cm.date = arrow.now().datetime
+                cm.title = "<p>Meeting %d</p>" % i
+                db.session.add(cm)
+            db.session.commit()
+
+            batches = list(Search().read_batches(CommitteeMeeting, 2))
+            assert_equal([2, 2, 1], [len(b) for b in batches])
+
+            bulk_index.reset_mock()
+            Search().reindex_for_model(CommitteeMeeting)
+
+            items = [item for call in bulk_index.call_args_list for item in call[0][2]]
+            assert_equal(5, len(items))
+            assert_in(u"Meeting 0", [item['title'] for item in items])
+
+    @patch.object(ElasticSearch, 'bulk_index')
+    @patch.object(ElasticSearch, 'delete')
+    @patch.object(Search, 'scan')
+    @patch.multiple(Search, reindex_changes=False, queue_changes=False, sync_changes=True)
+    def test_sync(self, scan, delete, bulk_index):
+        with app.app_context():
+            old = CommitteeMeeting(date=arrow.now().datetime, title="Old")
+            deleted = CommitteeMeeting(date=arrow.now().datetime, title="Deleted")
+            db.session.add_all([old, deleted])
+            db.session.commit()
+            SearchSync.mark('committee_meeting', datetime.now(pytz.utc) + timedelta(hours=1))
+
+            new = CommitteeMeeting(date=arrow.now().datetime, title="New")
+            db.session.add(new)
+            db.session.commit()
+            new.updated_at = datetime.now(pytz.utc) + timedelta(hours=2)
+            db.session.commit()
+            new_id = new.id
+
+            # only deletions are queued for the sync
+            deleted_id = deleted.id
+            db.session.delete(deleted)
+            db.session.commit()
+            assert_equal([deleted_id], [q.model_id for q in SearchQueue.query.all()])
+
+            bulk_index.reset_mock()
+            Search().sync('committee_meeting')
+
+            items = bulk_index.call_args[0][2]
+            assert_equal([new_id], [item['model_id'] for item in items])
+            delete.assert_called_once_with('pmg', 'committee_meeting', deleted_id)
+            assert_equal(0, SearchQueue.query.count())
+            # the index isn't scanned for deleted items
+            assert_false(scan.called)
+
+    @patch.object(Search, 'reindex_all')
+    def test_sync_needs_reindex_first(self, reindex_all):
+        with app.app_context():
+            Search().sync('committee_meeting')
+            assert_false(reindex_all.called)
+            assert_is_none(SearchSync.watermark('committee_meeting'))
+
+    @patch('pmg.models.resources.pdf_to_text')
+    def test_file_text_extracted_once(self, pdf_to_text):
+        pdf_to_text.return_value = u'New text'
+
+        with app.app_context(), tempfile.NamedTemporaryFile(dir='/tmp', suffix='.pdf') as f:
+            f.write('old pdf')
+            f.flush()
+            file = File(file_path=f.name, file_mime='application/pdf')
+            db.session.add(file)
+            db.session.commit()
+
+            FileText.store(file.id, hashlib.md5('old pdf').hexdigest(), u'Cached text')
+            assert_equal(u'Cached text', file.get_text())
+            assert_false(pdf_to_text.called)
+
+            # the content changed, so it's extracted again, and only once
+            f.write(' and more')
+            f.flush()
+            assert_equal(u'New text', file.get_text())
+            assert_equal(u'New text', file.get_text())
+            assert_equal(1, pdf_to_text.call_count)
+
+    def test_missing_file_has_no_text(self):
+        with app.app_context():
+            file = File(file_path='/tmp/missing.pdf', file_mime='application/pdf')
+            db.session.add(file)
+            db.session.commit()
+            assert_equal(u'', file.get_text())
+
+    def test_attachments_not_stripped(self):
+        item = clean_item({'title': u'<p>Bill</p>', 'attachments': u'if a < b then'})
+        assert_equal(u'Bill', item['title'])
+        assert_equal(u'if a < b then', item['attachments'])
+
+    @patch.object(File, 'get_text')
+    def test_file_text_extracted_when_cleaned(self, get_text):
+        get_text.return_value = u'if a < b then'
+        with app.app_context():
+            file = File(file_path='/tmp/bill.pdf', file_mime='application/pdf')
+            db.session.add(file)
+            db.session.commit()
+
+            item = {'attachments': (file.id, file.file_path, file.file_mime)}
+            assert_equal(u'if a < b then', clean_item(item)['attachments'])
+
+    @patch.object(ElasticSearch, 'delete')
+    @patch.multiple(Search, create_index=lambda self: 'pmg-new', mapping=lambda self, data_type, index: None,
+                    reindex_for_model=lambda self, model, index: None, swap_index=lambda self, index: None)
+    @patch.object(Search, 'scan')
+    def test_reindex_everything_deletes_missing(self, scan, delete):
+        with app.app_context():
+            # deleted while the new index was being built
+            scan.side_effect = lambda data_type, fields, index: [
+                {'_id': 999999, '_source': {'model_id': 999999, 'slug_prefix': 'committee-meeting'}},
+            ] if data_type == 'committee_meeting' else []
+
+            Search().reindex_everything()
+            delete.assert_called_once_with('pmg-new', 'committee_meeting', 999999)
@@ -0,0 +1,22 @@
+from datetime import datetime, date
+
+from tests import PMGTestCase
+from pmg.models import db, House
+from pmg.models.serializers import to_json, to_json_fast
+
+
+class TestSerializers(PMGTestCase):
+    def test_fast_encoder_matches(self):
+        house = House(name='National Assembly', sphere='national', name_short='na')
+        db.session.add(house)
+        db.session.commit()
+
+        data = {
+            'count': 2,
+            'next': None,
+            'results': [
+                {'id': 1, 'date': date(2019, 1, 1), 'title': u'Caf\xe9', 'tags': ('a', 'b')},
+                {'id': 2, 'date': datetime(2019, 1, 1, 10, 30), 'score': 1.5, 'house': house},
+            ],
+        }
+        self.assertEqual(to_json(data), to_json_fast(data))
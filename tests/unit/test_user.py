@@ -1,7 +1,7 @@
 from nose.tools import *  # noqa
 import datetime
 
-from pmg.models import User
+from pmg.models import db, User, Organisation, Committee, House
 from tests import PMGTestCase
 
 
@@ -13,3 +13,23 @@ class TestUser(PMGTestCase):
 
         u.expiry = datetime.date.today() + datetime.timedelta(days=2)
         assert_false(u.has_expired())
+
+    def test_subscribed_committee_ids(self):
+        house = House(name='National Assembly', sphere='national', name_short='na')
+        mine = Committee(name='Arts', house=house, premium=True)
+        theirs = Committee(name='Communications', house=house, premium=True)
+        other = Committee(name='Finance', house=house, premium=True)
+        org = Organisation(name='Org', domain='org.test', paid_subscriber=True)
+        org.subscriptions = [theirs]
+        u = User(email='user@org.test', active=True, organisation=org)
+        u.subscriptions = [mine]
+        db.session.add(u)
+        db.session.commit()
+
+        assert_equal(frozenset([mine.id, theirs.id]), u.subscribed_committee_ids())
+        assert_true(u.subscribed_to_committee(theirs))
+        assert_false(u.subscribed_to_committee(other))
+
+        # expiring the organisation expires its users too
+        org.expiry = datetime.date(2010, 1, 1)
+        assert_equal(frozenset(), u.subscribed_committee_ids())